@@ -1,6 +1,26 @@
-from argparse import ArgumentParser
-import sys
+"""
+Assembler for the SAP-1 8-bit breadboard computer.
+
+The program is assembled in two passes. The first pass parses each line on its
+own, producing a list of tokens. Each token represents one byte in memory. The
+second pass assigns a memory address to each token, defines the labels,
+constants (``.const NAME = value``) and macros (``.macro name params`` ...
+``.endm``), expands the macros, follows ``.org`` directives and translates the
+tokens into binary code. Parameters can be expressions such as ``label+1``,
+which are evaluated at the very end, so labels can be used before they are
+defined.
+
+Problems with the program are collected as diagnostics, rather than stopping
+at the first one. The result of the first pass is remembered for each line, so
+when a line of a program is edited, only that line is parsed again and only
+the memory addresses affected by the change are assembled again (see
+``Program``).
+"""
+from collections import namedtuple
+from functools import lru_cache
+import re
 import struct
+import sys
 
 opcodes = {
     'nop': 0,
@@ -17,93 +37,739 @@ opcodes = {
 }
 num_to_instruction = {v: k for k, v in opcodes.items()}
 
+# Instructions that don't take a parameter
+_NO_PARAMS = ['nop', 'out', 'hlt']
 
-def assemble(program_code, verbose=False):
-    # Keep track of the memory addresses at which labels are defined
-    labels = dict()
+# Number of bytes of RAM. The memory address register has 4 bits.
+RAM_SIZE = 16
 
+# A single byte of the program. The parameter is a number, an expression (such
+# as "label+1") that is evaluated in the second pass, or None.
+Token = namedtuple('Token', ['instruction', 'param'])
 
-    # Step 1: Parse file, producing a list of tokens. Each token represents one
-    # byte in memory. These tokens will be translated into binary code during
-    # the next step.
-    tokens = list()
+# The result of the first pass over a single line: the label defined on the
+# line (or None), the tokens, a directive (or None) and a list of (severity,
+# message) problems. Directives are tuples:
+#
+# - ('.const', name, expression): define a constant
+# - ('.org', expression): continue at the given memory address
+# - ('.macro', name, params): start the definition of a macro
+# - ('.endm',): end the definition of a macro
+# - ('call', name, args): use a macro
+ParsedLine = namedtuple('ParsedLine', ['label', 'tokens', 'directive', 'problems'])
 
-    for line_nr, line in enumerate(program_code.split('\n')):
-        def error(msg):
-            print(f'L{line_nr + 1}: {line}')
-            print(msg)
-            sys.exit(1)
+# A term of an expression: a number in decimal, hexadecimal (0x) or binary
+# (0b) notation, or the name of a label or constant.
+_TERM = r'(?:0x[0-9a-f]+|0b[01]+|\w+)'
 
-        # Deal with comments
-        if ';' in line:
-            line, _ = line.split(';', 1)
-        
-        # Deal with labels:
-        if ':' in line:
-            label, line = line.split(':', 1)
-            labels[label.strip().lower()] = len(tokens)
-
-        line = line.strip()
-        if len(line) == 0:
-            continue
-
-        instruction, *params = line.split()
-        instruction = instruction.lower()
-        if instruction in ['nop', 'out', 'hlt']:
-            if len(params) > 0:
-                error(f'{instruction} takes no parameters')
-            tokens.append((instruction,))
-        else:
-            if len(params) != 1:
-                error(f'{instruction} takes a single parameter')
-            param = params[0]
-            if param.isnumeric():
-                param = int(param)
-                if not (0 <= param <= 255):
-                    error('Parameter must be 0-255')
-
-            tokens.append((instruction, param))
-
-    # Convert each token to a binary number
-    bin_output = list()
-    for token in tokens:
-        instruction = token[0]
-
-        # Get the opcode for the instruction and place it into the upper 4 bits
-        # of the memory.
-        if instruction == 'db':
-            # The "db" pseudo-instruction has no opcode.
-            bin_line = 0
+# An expression: terms that are added or subtracted
+_EXPRESSION = re.compile(rf'\s*[+-]?\s*{_TERM}(?:\s*[+-]\s*{_TERM})*\s*', re.IGNORECASE)
+
+# How deep macros can be used inside other macros
+MAX_MACRO_DEPTH = 16
+
+
+class Diagnostic(namedtuple('Diagnostic', ['line_nr', 'severity', 'message', 'line'])):
+    """A problem with the program.
+
+    Parameters
+    ----------
+    line_nr : int
+        The line on which the problem occurs, counting from 0.
+    severity : 'error' | 'warning'
+        Errors prevent the program from being assembled, warnings don't.
+    message : str
+        Description of the problem.
+    line : str
+        The line of the program.
+    """
+    __slots__ = ()
+
+    def __str__(self):
+        message = self.message if self.severity == 'error' else f'Warning: {self.message}'
+        return f'L{self.line_nr + 1}: {self.line}\n{message}'
+
+
+class AssemblerError(ValueError):
+    """Raised by ``assemble()`` when the program contains errors.
+
+    Parameters
+    ----------
+    diagnostics : list of Diagnostic
+        The errors.
+    """
+    def __init__(self, diagnostics):
+        super().__init__('\n'.join(str(diagnostic) for diagnostic in diagnostics))
+        self.diagnostics = diagnostics
+
+
+@lru_cache(maxsize=4096)
+def parse_line(line):
+    """Parse a single line of a program (the first pass of the assembler).
+
+    The result only depends on the line itself, so it is cached.
+
+    Parameters
+    ----------
+    line : str
+        The line of the program.
+
+    Returns
+    -------
+    parsed : ParsedLine
+        The label defined on the line, the tokens, the directive and any
+        problems.
+    """
+    label = None
+    problems = list()
+
+    def result(tokens=(), directive=None):
+        return ParsedLine(label, tuple(tokens), directive, tuple(problems))
+
+    # Deal with comments
+    if ';' in line:
+        line, _ = line.split(';', 1)
+
+    # Deal with labels:
+    if ':' in line:
+        label, line = line.split(':', 1)
+        label = label.strip().lower()
+        if not _is_label(label):
+            problems.append(('error', f'Invalid label: "{label}"'))
+            label = None
+
+    line = line.strip()
+    if len(line) == 0:
+        return result()
+
+    instruction, *rest = line.split(None, 1)
+    instruction = instruction.lower()
+    rest = rest[0] if rest else ''
+
+    if instruction == '.const':
+        match = re.fullmatch(r'(\w+)\s*=(.+)', rest)
+        if match is None or not _is_label(match.group(1).lower()) or not _EXPRESSION.fullmatch(match.group(2)):
+            problems.append(('error', 'Expected ".const NAME = value"'))
+            return result()
+        return result(directive=('.const', match.group(1).lower(), match.group(2).strip()))
+
+    if instruction == '.org':
+        if not _EXPRESSION.fullmatch(rest):
+            problems.append(('error', 'Expected ".org address"'))
+            return result()
+        return result(directive=('.org', rest.strip()))
+
+    if instruction == '.macro':
+        name, *params = rest.replace(',', ' ').split() or ['']
+        if not _is_label(name.lower()) or name.lower() in opcodes or name.lower() == 'db':
+            problems.append(('error', f'Invalid macro name: "{name}"'))
+            return result()
+        for param in params:
+            if not _is_label(param.lower()):
+                problems.append(('error', f'Invalid macro parameter: "{param}"'))
+                return result()
+        return result(directive=('.macro', name.lower(), tuple(param.lower() for param in params)))
+
+    if instruction == '.endm':
+        return result(directive=('.endm',))
+
+    if instruction.startswith('.'):
+        problems.append(('error', f'Unknown directive: {instruction}'))
+        return result()
+
+    if instruction == 'db':
+        if not rest:
+            problems.append(('error', 'db takes at least one parameter'))
+            return result([Token(instruction, 0)])
+        return result([Token(instruction, _parse_param(value.strip(), 255, problems))
+                       for value in rest.split(',')])
+
+    if instruction in _NO_PARAMS:
+        if rest:
+            problems.append(('error', f'{instruction} takes no parameters'))
+        return result([Token(instruction, None)])
+
+    if instruction in opcodes:
+        if not rest or not _EXPRESSION.fullmatch(rest) and (',' in rest or len(rest.split()) > 1):
+            problems.append(('error', f'{instruction} takes a single parameter'))
+            return result([Token(instruction, 0)])
+        return result([Token(instruction, _parse_param(rest.strip(), 15, problems))])
+
+    # Anything else is the use of a macro, which may not be defined yet
+    args = tuple(arg.strip() for arg in rest.split(',')) if rest else ()
+    return result(directive=('call', instruction, args))
+
+
+def _parse_param(param, max_value, problems):
+    """Parse the parameter of an instruction. Numbers are checked right away,
+    expressions are evaluated in the second pass."""
+    number = _number(param)
+    if number is not None:
+        if not (0 <= number <= max_value):
+            problems.append(('error', f'Parameter must be 0-{max_value}'))
+            return 0
+        return number
+    if not _EXPRESSION.fullmatch(param):
+        problems.append(('error', f'Invalid parameter: {param}'))
+        return 0
+    return param
+
+
+def _number(text):
+    """Parse a number in decimal, hexadecimal (0x) or binary (0b) notation.
+    Returns ``None`` if the text is not a number."""
+    text = text.lower()
+    if text.isdecimal():
+        return int(text)
+    if re.fullmatch(r'0x[0-9a-f]+|0b[01]+', text):
+        return int(text, 0)
+    return None
+
+
+def _is_label(name):
+    """Whether the text can be used as the name of a label."""
+    return re.fullmatch(r'\w+', name) is not None and not name.isdecimal()
+
+
+def evaluate(expression, symbols):
+    """Evaluate an expression, such as ``label+1``.
+
+    Parameters
+    ----------
+    expression : str
+        The expression. It consists of numbers and the names of labels or
+        constants, which are added or subtracted.
+    symbols : dict of str -> int
+        The value of each label and constant.
+
+    Returns
+    -------
+    value : int
+        The value of the expression.
+
+    Raises
+    ------
+    KeyError
+        When the expression uses an unknown label or constant.
+    """
+    value = 0
+    for sign, term in re.findall(rf'([+-]?)\s*({_TERM})', expression, re.IGNORECASE):
+        number = _number(term)
+        if number is None:
+            number = symbols[term.lower()]
+        value = value - number if sign == '-' else value + number
+    return value
+
+
+@lru_cache(maxsize=4096)
+def _expand_macro(body, params, args):
+    """Substitute the arguments for the parameters in the body of a macro and
+    parse the result. The expansion is cached, so a macro that is used many
+    times with the same arguments is only expanded once."""
+    if params:
+        values = dict(zip(params, args))
+        pattern = re.compile(r'\b(' + '|'.join(re.escape(param) for param in params) + r')\b', re.IGNORECASE)
+        body = [pattern.sub(lambda match: values[match.group(0).lower()], line) for line in body]
+    return tuple(parse_line(line) for line in body)
+
+
+class Program:
+    """A program, assembled into the contents of the memory.
+
+    The program can be changed with ``update()`` or ``edit_line()``. After
+    ``edit_line()``, only the edited line is parsed and placed again. When its
+    size changed, the lines that follow it move along, up to the next
+    ``.org``. Finally, the parameters that refer to labels that moved are
+    evaluated again. Edits that can affect the rest of the program in other
+    ways, such as changing a directive or a line inside a macro, run the whole
+    second pass again.
+
+    Parameters
+    ----------
+    program_code : str
+        The program, written in assembly language.
+
+    Attributes
+    ----------
+    lines : list of str
+        The lines of the program.
+    memory : list of int
+        The assembled binary contents of the memory.
+    human_readable : list of str
+        For each memory address, a human readable version of the contents.
+    labels : dict of str -> int
+        The labels defined in the program, along with the memory address they
+        refer to.
+    constants : dict of str -> int
+        The constants defined in the program, along with their value.
+    macros : dict of str -> (tuple of str, tuple of str)
+        The macros defined in the program, along with their parameters and
+        the lines of their body.
+    line_tokens : list of tuple of Token
+        For each line, the tokens on that line.
+    line_addresses : list of int
+        For each line, the memory address of its first token. Lines without
+        tokens get the address of the next token.
+    """
+    def __init__(self, program_code=''):
+        self.update(program_code)
+
+    def update(self, program_code):
+        """Replace the program with a new version.
+
+        Parameters
+        ----------
+        program_code : str
+            The program, written in assembly language.
+        """
+        self.lines = program_code.split('\n')
+        self._parsed = [parse_line(line) for line in self.lines]
+        self._link()
+
+    def edit_line(self, line_nr, line):
+        """Replace a single line of the program.
+
+        Parameters
+        ----------
+        line_nr : int
+            The line to replace, counting from 0.
+        line : str
+            The new contents of the line.
+        """
+        old = self._parsed[line_nr]
+        self.lines[line_nr] = line
+        self._parsed[line_nr] = parse_line(line)
+        if not self._relink_line(line_nr, old):
+            self._link()
+
+    @property
+    def diagnostics(self):
+        """The problems with the program, as a list of ``Diagnostic``."""
+        diagnostics = [diagnostic for line_diagnostics in self._line_diagnostics
+                       for diagnostic in line_diagnostics]
+        if self._fit_warning is not None:
+            diagnostics.append(self._fit_warning)
+        diagnostics += [self._value_diagnostics[address] for address in sorted(self._value_diagnostics)]
+        diagnostics.sort(key=lambda diagnostic: diagnostic.line_nr)
+        return diagnostics
+
+    @property
+    def errors(self):
+        """The diagnostics that prevent the program from being assembled."""
+        return [diagnostic for diagnostic in self.diagnostics if diagnostic.severity == 'error']
+
+    def line_at(self, address):
+        """Find the line that produced the contents of a memory address.
+
+        Parameters
+        ----------
+        address : int
+            The memory address.
+
+        Returns
+        -------
+        line_nr : int | None
+            The line, counting from 0, or ``None`` if the address is not part
+            of the program.
+        """
+        if address not in self._placed:
+            return None
+        return self._placed[address][1]
+
+    def _link(self):
+        """Assign a memory address to each token, define the labels,
+        constants and macros, and produce the binary code (the second pass of
+        the assembler)."""
+        self._line_diagnostics = [list() for _ in self.lines]
+        self._value_diagnostics = dict()
+        self.labels = dict()
+        self.constants = dict()
+        self.macros = dict()
+        self.line_tokens = [() for _ in self.lines]
+        self.line_addresses = list()
+
+        # For each memory address, the token placed there and the line it came
+        # from.
+        self._placed = dict()
+        self._address = 0
+
+        # The labels and constants defined so far
+        self._symbols = dict()
+
+        # Bookkeeping for edit_line():
+        # - for each label, the order in which it was defined
+        # - for each label or constant, the lines with parameters that use it
+        # - the names used by directives, which are evaluated right away
+        # - the lines that are part of a macro definition
+        # - for lines that use a macro, the addresses of the tokens it produced
+        # - whether a name was defined twice or an address used twice
+        self._label_order = dict()
+        self._references = dict()
+        self._directive_names = set()
+        self._macro_lines = set()
+        self._call_addresses = dict()
+        self._conflicts = False
+
+        # The name, parameters, body and line of the macro being defined
+        definition = None
+
+        for line_nr, parsed in enumerate(self._parsed):
+            self.line_addresses.append(self._address)
+            directive = parsed.directive
+            if definition is not None:
+                self._macro_lines.add(line_nr)
+                name, params, body, _ = definition
+                if directive == ('.endm',):
+                    self.macros[name] = (params, tuple(body))
+                    definition = None
+                elif directive is not None and directive[0] == '.macro':
+                    self._report(line_nr, 'error', 'Macros cannot be defined inside other macros')
+                else:
+                    body.append(self.lines[line_nr])
+            elif directive is not None and directive[0] == '.macro':
+                self._macro_lines.add(line_nr)
+                for severity, message in parsed.problems:
+                    self._report(line_nr, severity, message)
+                definition = (directive[1], directive[2], list(), line_nr)
+            else:
+                self._assemble_line(line_nr, parsed)
+        if definition is not None:
+            self._report(definition[3], 'error', f'Macro "{definition[0]}" is missing .endm')
+
+        # For each address, the labels that refer to it
+        self._labels_at = dict()
+        for name, address in self.labels.items():
+            self._labels_at.setdefault(address, set()).add(name)
+
+        # Convert each token to a binary number
+        self._symbols = dict(self.labels, **self.constants)
+        size = max(self._placed) + 1 if self._placed else 0
+        self.memory = [0] * size
+        self.human_readable = [None] * size
+        for address in range(size):
+            self._evaluate_token(address)
+            self._describe(address)
+        self._check_fit()
+
+    def _relink_line(self, line_nr, old):
+        """Redo the second pass after a single line has changed, for only the
+        addresses that are affected by the change.
+
+        Parameters
+        ----------
+        line_nr : int
+            The line that changed.
+        old : ParsedLine
+            The line as it was before the change.
+
+        Returns
+        -------
+        success : bool
+            Whether the change could be handled. If not, the whole second pass
+            needs to run again.
+        """
+        new = self._parsed[line_nr]
+        if (self._conflicts or line_nr in self._macro_lines
+                or old.directive is not None or new.directive is not None):
+            return False
+        if new.label != old.label and new.label is not None and new.label in self._symbols:
+            return False
+
+        # The lines that follow move along when the size of the line changed,
+        # up to the next .org.
+        address = self.line_addresses[line_nr]
+        delta = len(new.tokens) - len(old.tokens)
+        moved_labels = list()
+        end = line_nr + 1
+        n_moved_tokens = 0
+        if delta:
+            while end < len(self.lines):
+                parsed = self._parsed[end]
+                if end not in self._macro_lines:
+                    directive = parsed.directive
+                    if directive is not None and directive[0] != '.org':
+                        return False
+                    if parsed.label is not None:
+                        moved_labels.append(parsed.label)
+                    if directive is not None:
+                        # Only an .org whose address doesn't depend on labels
+                        # stays in place.
+                        if self._line_diagnostics[end] or not _names(directive[1]) <= self.constants.keys():
+                            return False
+                        break
+                    n_moved_tokens += len(self.line_tokens[end])
+                end += 1
+        old_end = address + len(old.tokens) + n_moved_tokens
+        if any(a in self._placed for a in range(old_end, old_end + delta)):
+            return False
+
+        changed = set(moved_labels)
+        if new.label != old.label:
+            changed.update(label for label in (old.label, new.label) if label is not None)
+        if changed & self._directive_names:
+            return False
+
+        # Place the tokens of the line and move the ones that follow
+        moved = [self._placed.pop(a) for a in range(address, old_end)][len(old.tokens):]
+        placed = [(token, line_nr, '') for token in new.tokens] + moved
+        for a, entry in enumerate(placed, address):
+            self._placed[a] = entry
+        self.line_tokens[line_nr] = new.tokens
+        for moved_line_nr in range(line_nr + 1, end):
+            self.line_addresses[moved_line_nr] += delta
+        self._line_diagnostics[line_nr] = [Diagnostic(line_nr, severity, message, self.lines[line_nr])
+                                           for severity, message in new.problems]
+        for name in _token_names(old.tokens):
+            self._references[name].discard(line_nr)
+        for name in _token_names(new.tokens):
+            self._references.setdefault(name, set()).add(line_nr)
+
+        # Update the labels
+        affected = set(range(address, max(old_end, old_end + delta)))
+        if old.label is not None and old.label != new.label:
+            affected.add(self._remove_label(old.label))
+        for label in moved_labels:
+            affected.add(self.labels[label])
+            affected.add(self._move_label(label, self.labels[label] + delta))
+        if new.label is not None and new.label != old.label:
+            self._label_order[new.label] = (line_nr, 0)
+            affected.add(self._move_label(new.label, address))
+            # Keep the labels in the order in which they are defined
+            self.labels = dict(sorted(self.labels.items(), key=lambda item: self._label_order[item[0]]))
+
+        # Evaluate the parameters that use labels that moved
+        for name in changed:
+            for reference_line_nr in self._references.get(name, ()):
+                if reference_line_nr in self._call_addresses:
+                    affected.update(self._call_addresses[reference_line_nr])
+                else:
+                    start = self.line_addresses[reference_line_nr]
+                    affected.update(range(start, start + len(self.line_tokens[reference_line_nr])))
+
+        size = max(self._placed) + 1 if self._placed else 0
+        if size < len(self.memory):
+            del self.memory[size:]
+            del self.human_readable[size:]
         else:
-            bin_line = opcodes[instruction.lower()] << 4
-
-        # If the instruction has a parameter, place it into the lower 4 bits of
-        # the memory.
-        if len(token) == 2:
-            param = token[1]
-            # Parameter could be a label, in which case, translate it into the
-            # memory address it refers to.
-            if type(param) == str:
-                param = labels[param]
-            # Place parameter value into the lower 4 bits
+            affected.update(range(len(self.memory), size))
+            self.memory += [0] * (size - len(self.memory))
+            self.human_readable += [None] * (size - len(self.human_readable))
+        for a in affected:
+            if a < size:
+                self._evaluate_token(a)
+                self._describe(a)
+            else:
+                self._value_diagnostics.pop(a, None)
+        self._check_fit()
+        return True
+
+    def _assemble_line(self, line_nr, parsed, prefix='', depth=0):
+        """Place the tokens of a parsed line in memory and handle its label
+        and directive. Lines produced by macros are reported on the line where
+        the macro is used, with the given prefix."""
+        for severity, message in parsed.problems:
+            self._report(line_nr, severity, prefix + message)
+
+        if parsed.label is not None:
+            self._define(line_nr, parsed.label, self._address, self.labels, prefix)
+            self._label_order.setdefault(parsed.label, (line_nr, len(self._label_order)))
+
+        directive = parsed.directive
+        if directive is None:
+            pass
+        elif directive[0] == '.const':
+            _, name, expression = directive
+            value = self._evaluate_now(line_nr, expression, prefix)
+            if value is not None:
+                self._define(line_nr, name, value, self.constants, prefix)
+        elif directive[0] == '.org':
+            value = self._evaluate_now(line_nr, directive[1], prefix)
+            if value is not None:
+                if not (0 <= value <= 255):
+                    self._report(line_nr, 'error', f'{prefix}Address must be 0-255')
+                else:
+                    self._address = value
+                    self.line_addresses[line_nr] = value
+        elif directive[0] == '.macro':
+            self._report(line_nr, 'error', f'{prefix}Macros cannot be defined inside other macros')
+        elif directive[0] == '.endm':
+            self._report(line_nr, 'error', f'{prefix}.endm without .macro')
+        elif directive[0] == 'call':
+            _, name, args = directive
+            self._call_addresses.setdefault(line_nr, list())
+            if name not in self.macros:
+                self._report(line_nr, 'error', f'{prefix}Unknown instruction: {name}')
+            elif depth >= MAX_MACRO_DEPTH:
+                self._report(line_nr, 'error', f'{prefix}Macros are nested too deeply')
+            else:
+                params, body = self.macros[name]
+                if len(args) != len(params):
+                    self._report(line_nr, 'error', f'{prefix}Macro "{name}" takes {len(params)} '
+                                                   f'parameters, but got {len(args)}')
+                else:
+                    for expanded in _expand_macro(body, params, args):
+                        self._assemble_line(line_nr, expanded, f'{prefix}In macro "{name}": ', depth + 1)
+
+        for token in parsed.tokens:
+            if self._address in self._placed:
+                self._report(line_nr, 'error', f'{prefix}Address {self._address} is already in use')
+                self._conflicts = True
+            self._placed[self._address] = (token, line_nr, prefix)
+            self.line_tokens[line_nr] += (token,)
+            if line_nr in self._call_addresses:
+                self._call_addresses[line_nr].append(self._address)
+            if isinstance(token.param, str):
+                for name in _names(token.param):
+                    self._references.setdefault(name, set()).add(line_nr)
+            self._address += 1
+
+    def _evaluate_token(self, address):
+        """Convert the token at a memory address to a binary number."""
+        self._value_diagnostics.pop(address, None)
+        if address not in self._placed:
+            self.memory[address] = 0
+            return
+        (instruction, param), line_nr, prefix = self._placed[address]
+
+        # Get the opcode for the instruction and place it into the upper 4
+        # bits of the memory. The "db" pseudo-instruction has no opcode.
+        bin_line = 0 if instruction == 'db' else opcodes[instruction] << 4
+
+        # Parameter could be an expression using labels, in which case,
+        # translate it into the value it refers to.
+        if isinstance(param, str):
+            max_value = 255 if instruction == 'db' else 15
+            try:
+                value = evaluate(param, self._symbols)
+            except KeyError as e:
+                self._value_diagnostics[address] = Diagnostic(
+                    line_nr, 'error', f'{prefix}Unknown label: {e.args[0]}', self.lines[line_nr])
+                value = 0
+            if not (0 <= value <= max_value):
+                self._value_diagnostics[address] = Diagnostic(
+                    line_nr, 'error', f'{prefix}"{param}" is {value}, which does not fit in '
+                                      f'{4 if max_value == 15 else 8} bits', self.lines[line_nr])
+                value = 0
+            param = value
+        if param is not None:
             bin_line += param
-        bin_output.append(bin_line)
-
-    # Create human readable version of the memory contents
-    human_readable = list()
-    addr_to_label = {v: k for k, v in labels.items()}
-    for addr, (t, b) in enumerate(zip(tokens, bin_output)):
-        i = ' '.join([str(x) for x in t])
-        label = addr_to_label.get(addr, '')
-        if label:
-            label = f'({label})'
-        human_readable.append(f"{addr:02d}: {b >> 4:04b} {b & 0x0f:04b}  {i} {label}")
+        self.memory[address] = bin_line
+
+    def _describe(self, address):
+        """Create a human readable version of the contents of a memory
+        address."""
+        b = self.memory[address]
+        token = self._placed[address][0] if address in self._placed else None
+        i = ' '.join([str(x) for x in token if x is not None]) if token is not None else ''
+        labels = self._labels_at.get(address)
+        # When multiple labels refer to the same address, show the last one
+        label = f'({max(labels, key=self._label_order.get)})' if labels else ''
+        self.human_readable[address] = f"{address:02d}: {b >> 4:04b} {b & 0x0f:04b}  {i} {label}"
+
+    def _check_fit(self):
+        """Warn when the program does not fit in the RAM."""
+        beyond = [address for address in self._placed if address >= RAM_SIZE]
+        if beyond:
+            line_nr = self._placed[min(beyond)][1]
+            self._fit_warning = Diagnostic(line_nr, 'warning', f'The program does not fit in the '
+                                                               f'{RAM_SIZE} bytes of RAM', self.lines[line_nr])
+        else:
+            self._fit_warning = None
+
+    def _move_label(self, name, address):
+        """Define a label or change its address. Returns the new address."""
+        if name in self.labels:
+            self._labels_at[self.labels[name]].discard(name)
+        self.labels[name] = address
+        self._symbols[name] = address
+        self._labels_at.setdefault(address, set()).add(name)
+        return address
+
+    def _remove_label(self, name):
+        """Remove a label. Returns the address it referred to."""
+        address = self.labels.pop(name)
+        del self._symbols[name]
+        del self._label_order[name]
+        self._labels_at[address].discard(name)
+        return address
+
+    def _define(self, line_nr, name, value, symbols, prefix=''):
+        """Define a label or constant."""
+        if name in self.labels or name in self.constants:
+            self._report(line_nr, 'error', f'{prefix}Label "{name}" is already defined')
+            self._conflicts = True
+        symbols[name] = value
+        self._symbols[name] = value
+
+    def _evaluate_now(self, line_nr, expression, prefix=''):
+        """Evaluate an expression during the second pass. Only the labels and
+        constants that are defined before are known at this point."""
+        self._directive_names.update(_names(expression))
+        try:
+            return evaluate(expression, self._symbols)
+        except KeyError as e:
+            self._report(line_nr, 'error', f'{prefix}Unknown label: {e.args[0]} (it must be defined before this line)')
+            return None
+
+    def _report(self, line_nr, severity, message):
+        """Add a diagnostic."""
+        self._line_diagnostics[line_nr].append(Diagnostic(line_nr, severity, message, self.lines[line_nr]))
+
+
+@lru_cache(maxsize=4096)
+def _names(expression):
+    """Get the names of the labels and constants used in an expression."""
+    return frozenset(term.lower() for term in re.findall(_TERM, expression, re.IGNORECASE) if _number(term) is None)
+
+
+def _token_names(tokens):
+    """Get the names of the labels and constants used by the parameters of
+    some tokens."""
+    return {name for _, param in tokens if isinstance(param, str) for name in _names(param)}
+
+
+def assemble(program_code, verbose=False, return_labels=False):
+    """Assemble a program.
+
+    Parameters
+    ----------
+    program_code : str
+        The program, written in assembly language.
+    verbose : bool
+        Whether to print the assembled program, along with any warnings.
+        Defaults to ``False``.
+    return_labels : bool
+        Whether to also return the labels defined in the program. Defaults to
+        ``False``.
+
+    Returns
+    -------
+    bin_output : list of int
+        The binary contents of the memory.
+    human_readable : list of str
+        For each memory address, a human readable version of the contents.
+    labels : dict of str -> int
+        The labels defined in the program, along with the memory address they
+        refer to. Only returned when ``return_labels=True``.
+
+    Raises
+    ------
+    AssemblerError
+        When the program contains errors.
+    """
+    program = Program(program_code)
+    if program.errors:
+        raise AssemblerError(program.errors)
 
     if verbose:
-        for line in human_readable:
+        for diagnostic in program.diagnostics:
+            print(diagnostic, file=sys.stderr)
+        for line in program.human_readable:
             print(line)
 
-    return bin_output, human_readable
+    if return_labels:
+        return program.memory, program.human_readable, program.labels
+    return program.memory, program.human_readable
 
 
 def disassemble(bin_code):
@@ -129,13 +795,19 @@ def disassemble(bin_code):
 
 
 if __name__ == '__main__':
+    from argparse import ArgumentParser
+
     parser = ArgumentParser(description='Assembler for the 8-bit breadboard computer. By default, just prints the assembled version of the code.')
     parser.add_argument('file', type=str, help='Assembly code file to assemble.')
     parser.add_argument('-o', '--output-file', type=str, default=None, help='Write the compiled program to a file.')
     args = parser.parse_args()
 
     with open(args.file) as f:
-        bin_output, _ = assemble(f.read(), verbose=True)
+        try:
+            bin_output, _ = assemble(f.read(), verbose=True)
+        except AssemblerError as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
 
     if args.output_file:
         with open(args.output_file, 'wb') as f:
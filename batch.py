@@ -0,0 +1,137 @@
+"""
+Run many programs, possibly with many versions of the microcode, on the SAP-1
+8-bit breadboard computer simulator.
+
+The combinations of programs and microcode are divided over a pool of worker
+processes. For each combination, the results are written to the standard
+output as a line of JSON as soon as they are available.
+
+Usage: python simulator.py batch [options] program_file [program_file ...]
+"""
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
+from itertools import product
+from time import perf_counter
+import json
+
+from assembler import assemble, AssemblerError
+from memory_backend import map_EEPROM
+from simulator import Simulator
+
+
+@lru_cache(maxsize=None)
+def _load_microcode(microcode_file):
+    """Load a microcode image. Each worker process only does this once for each
+    file."""
+    if microcode_file is None:
+        return None
+    return map_EEPROM(microcode_file)
+
+
+def run_job(program_file, microcode_file=None, binary=False, engine='subcycle', max_cycles=None,
+            timeout=None, detect_loops=False, coverage=False):
+    """Run a single program in batch mode.
+
+    Parameters
+    ----------
+    program_file : str
+        The program to execute.
+    microcode_file : str | None
+        The file containing the EEPROM contents to use as microcode. By default
+        (``None``) Ben Eater's original microcode is used.
+    binary : bool
+        Whether the program file is in binary rather than assembly language.
+        Defaults to ``False``.
+    engine : 'subcycle' | 'instruction'
+        Which simulator to use. Defaults to ``'subcycle'``.
+    max_cycles : int | None
+        Stop the program after this number of clock cycles, even when it has
+        not halted yet. By default (``None``), there is no limit.
+    timeout : float | None
+        Stop the program after this many seconds. By default (``None``), there
+        is no limit.
+    detect_loops : bool
+        Whether to stop the program when it is stuck in an infinite loop.
+        Defaults to ``False``.
+    coverage : bool
+        Whether to measure which parts of the microcode are used (see
+        microcode_coverage.py). Only supported by the subcycle engine.
+        Defaults to ``False``.
+
+    Returns
+    -------
+    result : dict
+        The result of running the program, containing the ``outputs``, whether
+        the program ``halted``, the ``reason`` it stopped (see
+        ``simulator.RunResult``), the program counter ``pc`` at the end, the
+        number of clock ``cycles`` and the ``wall_time`` it took in seconds.
+        When measuring the ``coverage``, the coverage map is included as well.
+        When something went wrong, the result only contains the ``error``
+        message instead.
+    """
+    result = dict(program=program_file, microcode=microcode_file)
+    try:
+        if binary:
+            with open(program_file, 'rb') as f:
+                memory, human_readable = list(f.read()), None
+        else:
+            with open(program_file) as f:
+                memory, human_readable = assemble(f.read())
+        simulator = Simulator(memory, human_readable, EEPROM=_load_microcode(microcode_file),
+                              engine=engine)
+        if coverage:
+            from microcode_coverage import MicrocodeCoverage
+            microcode_coverage = MicrocodeCoverage(_load_microcode(microcode_file))
+            microcode_coverage.sample(simulator.state)
+            simulator.add_observer(microcode_coverage)
+        start_time = perf_counter()
+        run_result = simulator.run(max_cycles, timeout, detect_loops)
+        result['wall_time'] = perf_counter() - start_time
+        result['outputs'] = run_result.outputs
+        result['halted'] = run_result.halted
+        result['reason'] = run_result.reason
+        result['pc'] = run_result.pc
+        result['cycles'] = run_result.cycles
+        if coverage:
+            result['coverage'] = microcode_coverage.to_dict()
+    except AssemblerError as e:
+        result['error'] = str(e)
+    except Exception as e:
+        result['error'] = repr(e)
+    return result
+
+
+def main(argv=None):
+    """Run the batch runner from the command line.
+
+    Parameters
+    ----------
+    argv : list of str | None
+        The command line arguments. By default (``None``), these are taken from
+        ``sys.argv``.
+    """
+    parser = ArgumentParser(prog='simulator.py batch', description=__doc__.split('\n\n')[1].replace('\n', ' '))
+    parser.add_argument('program_files', type=str, nargs='+', help='Programs to execute, written in assembly language.')
+    parser.add_argument('-m', '--microcode', type=str, metavar='bin_file', nargs='+', default=[None],
+                        help='EEPROM contents to use as microcode (as binary memory dumps). Each program is run with each version of the microcode. Defaults to Ben Eaters original microcode.')
+    parser.add_argument('-b', '--bin', action='store_true',
+                        help='Specify that the program files are in binary rather than assembly language.')
+    parser.add_argument('-e', '--engine', choices=['subcycle', 'instruction'], default='subcycle',
+                        help='Simulate both flanks of the clock (subcycle, the default) or a whole instruction at a time (instruction).')
+    parser.add_argument('-c', '--max-cycles', type=int, default=None,
+                        help='Stop each program after this number of clock cycles, even when it has not halted yet.')
+    parser.add_argument('-t', '--timeout', type=float, metavar='seconds', default=None,
+                        help='Stop each program after this number of seconds.')
+    parser.add_argument('-l', '--detect-loops', action='store_true',
+                        help='Stop programs that are stuck in an infinite loop.')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='Number of worker processes to use. Defaults to the number of CPUs.')
+    args = parser.parse_args(argv)
+
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = [executor.submit(run_job, program_file, microcode_file, args.bin, args.engine, args.max_cycles,
+                                   args.timeout, args.detect_loops)
+                   for microcode_file, program_file in product(args.microcode, args.program_files)]
+        for future in as_completed(futures):
+            print(json.dumps(future.result()), flush=True)
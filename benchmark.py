@@ -0,0 +1,447 @@
+"""
+Benchmarks for the simulator of the SAP-1 8-bit breadboard computer.
+
+For each program in example_programs/, the speed of ``State.step()`` is
+measured in half clock-cycles per second, both with and without keeping the
+undo history, along with the time ``State.revert()`` takes to undo a step and
+the time ``interface.update()`` takes to draw a frame on a fake curses screen.
+The throughput of ``assemble()`` is measured on large generated programs.
+
+The inputs are fixed, so runs can be compared. All measurements are repeated
+for a number of rounds and the best result of each is kept. The results can be saved as JSON
+and compared against an earlier run, in which case measurements that got worse
+by more than a tolerance are flagged as regressions.
+
+Usage: python benchmark.py [options] [program_file ...]
+"""
+from argparse import ArgumentParser
+from contextlib import contextmanager
+from functools import partial
+from time import perf_counter
+import gc
+import glob
+import json
+import os
+import platform
+import sys
+
+import microcode
+from assembler import assemble, parse_line
+from simulator import Simulator
+
+# The programs to run by default
+PROGRAMS = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                         'example_programs', '*.asm')))
+
+# For each kind of measurement: the unit and whether higher values are better.
+METRICS = {
+    'step': ('half-cycles/s', True),
+    'step_history': ('half-cycles/s', True),
+    'revert': ('us', False),
+    'assemble': ('lines/s', True),
+    'interface': ('us', False),
+}
+
+
+@contextmanager
+def _no_gc():
+    """Keep the garbage collector from interfering with a measurement."""
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def bench_step(simulator, n_steps, keep_history):
+    """Measure the speed of ``State.step()``. The program starts over whenever
+    it halts.
+
+    Parameters
+    ----------
+    simulator : Simulator
+        The simulator, with the program loaded.
+    n_steps : int
+        The number of steps (half clock-cycles) to take.
+    keep_history : bool
+        Whether to keep the undo history, as the interface does.
+
+    Returns
+    -------
+    rate : float
+        The speed, in half clock-cycles per second.
+    """
+    elapsed = 0
+    done = 0
+    while done < n_steps:
+        simulator.reset()
+        state = simulator.state
+        state.keep_history = keep_history
+        step = state.step
+        todo = n_steps - done
+        n = 0
+        with _no_gc():
+            start = perf_counter()
+            while n < todo and not state.control_signals & microcode.HLT:
+                step()
+                n += 1
+            elapsed += perf_counter() - start
+        if n == 0:
+            raise ValueError('The program halts before taking a single step.')
+        done += n
+    return n_steps / elapsed
+
+
+def bench_revert(simulator, n_steps):
+    """Measure how long ``State.revert()`` takes to undo a step. The program
+    starts over whenever it halts.
+
+    Parameters
+    ----------
+    simulator : Simulator
+        The simulator, with the program loaded.
+    n_steps : int
+        The number of steps (half clock-cycles) to undo.
+
+    Returns
+    -------
+    latency : float
+        The time to undo a single step, in microseconds.
+    """
+    # Don't depend on the settings left behind by other benchmarks
+    simulator.state.keep_history = True
+    simulator.state.history.clear()
+
+    elapsed = 0
+    done = 0
+    while done < n_steps:
+        simulator.reset()
+        state = simulator.state
+        n = 0
+        while n < n_steps - done and not state.halted:
+            state.step()
+            n += 1
+        with _no_gc():
+            start = perf_counter()
+            for _ in range(n):
+                state.revert()
+            elapsed += perf_counter() - start
+        if n == 0:
+            raise ValueError('The program halts before taking a single step.')
+        if state.cycles != 0 or state.clock:
+            raise RuntimeError('Not all steps could be undone.')
+        done += n
+    return elapsed / n_steps * 1e6
+
+
+class FakeScreen:
+    """Stands in for a curses screen, so the interface can be drawn without a
+    terminal. It only counts the characters that are drawn."""
+    def __init__(self):
+        self.n_chars = 0
+
+    def addstr(self, row, col, text, attr=0):
+        self.n_chars += len(text)
+
+    def move(self, row, col):
+        pass
+
+    def clrtoeol(self):
+        pass
+
+    def refresh(self):
+        pass
+
+    def clear(self):
+        pass
+
+
+def bench_interface(simulator, n_frames):
+    """Measure how long it takes to draw a frame of the interface.
+
+    Like in the interface, each frame is drawn by ``interface.update()`` from a
+    snapshot of the state, which is published by the worker thread (see
+    worker.py). Both are included in the frame time. The machine advances one
+    step between frames, so every frame has something new to draw.
+
+    Parameters
+    ----------
+    simulator : Simulator
+        The simulator, with the program loaded.
+    n_frames : int
+        The number of frames to draw.
+
+    Returns
+    -------
+    frame_time : float
+        The time to draw a frame, in microseconds.
+    """
+    import curses
+    import interface
+    from worker import SimulatorWorker
+
+    # Outside of curses.wrapper(), there are no colors to look up.
+    color_pair = curses.color_pair
+    curses.color_pair = lambda n: n << 8
+    try:
+        screen = FakeScreen()
+        simulator.reset()
+        interface._drawn.clear()
+        # The worker thread is not started, its snapshots are published by
+        # hand.
+        worker = SimulatorWorker(simulator)
+        elapsed = 0
+        for _ in range(n_frames):
+            if simulator.state.halted:
+                simulator.reset()
+                interface._drawn.clear()
+            simulator.state.step()
+            with _no_gc():
+                start = perf_counter()
+                worker._publish()
+                interface.update(screen, worker.snapshot)
+                elapsed += perf_counter() - start
+    finally:
+        curses.color_pair = color_pair
+        interface._drawn.clear()
+    return elapsed / n_frames * 1e6
+
+
+def generate_program(n_lines):
+    """Generate a large program that uses all features of the assembler.
+
+    The program is only meant to be assembled: it is far too big to fit in the
+    RAM.
+
+    Parameters
+    ----------
+    n_lines : int
+        The approximate number of lines of the program.
+
+    Returns
+    -------
+    program_code : str
+        The program.
+    """
+    lines = [
+        '; Generated by benchmark.py',
+        '.const ONE = 1',
+        '.macro addsub a, b',
+        '\tadd a',
+        '\tsub b',
+        '.endm',
+    ]
+    i = 0
+    while len(lines) < n_lines:
+        lines += [
+            f'block{i}:\tlda {i % 16}\t\t; load something',
+            f'\tadd ONE + {i % 8}',
+            f'\taddsub {i % 16}, 0x{(i * 7) % 16:x}',
+            f'.const VALUE{i} = {i % 200}',
+            f'\tdb VALUE{i} + ONE, 0b{i % 4:02b}, {(i * 13) % 256}',
+            f'\tjc {(i * 3) % 16}',
+            '\tout',
+            '',
+        ]
+        i += 1
+    return '\n'.join(lines) + '\n'
+
+
+def bench_assemble(program_code):
+    """Measure the throughput of ``assemble()``.
+
+    The cache of parsed lines is cleared first, so every line is parsed.
+
+    Parameters
+    ----------
+    program_code : str
+        The program to assemble, see ``generate_program()``.
+
+    Returns
+    -------
+    throughput : float
+        The throughput, in lines per second.
+    """
+    parse_line.cache_clear()
+    with _no_gc():
+        start = perf_counter()
+        assemble(program_code)
+        elapsed = perf_counter() - start
+    return program_code.count('\n') / elapsed
+
+
+def run_benchmarks(program_files, repeat=5, n_steps=50_000, n_lines=5_000, n_frames=1_000,
+                   interface=True, verbose=False):
+    """Run all benchmarks.
+
+    All measurements are taken once in each round and the best result of each
+    is kept. Spreading the repetitions over the whole run, rather than taking
+    them back to back, makes the results less sensitive to other processes
+    that are busy for a while.
+
+    Parameters
+    ----------
+    program_files : list of str
+        The programs to run, written in assembly language.
+    repeat : int
+        The number of rounds. Defaults to 5.
+    n_steps : int
+        The number of steps (half clock-cycles) to take for each program when
+        measuring the speed of the simulator and the undo history. Defaults to
+        50 000.
+    n_lines : int
+        The number of lines of the generated program to assemble. Defaults to
+        5 000.
+    n_frames : int
+        The number of frames of the interface to draw for each program.
+        Defaults to 1 000.
+    interface : bool
+        Whether to measure the interface. This needs the curses module.
+        Defaults to ``True``.
+    verbose : bool
+        Whether to report the progress on the standard error. Defaults to
+        ``False``.
+
+    Returns
+    -------
+    results : dict of str -> float
+        The results, named as ``metric/program``. See ``METRICS`` for the
+        units.
+    """
+    measurements = list()
+    for program_file in program_files:
+        program = os.path.splitext(os.path.basename(program_file))[0]
+        with open(program_file) as f:
+            memory, memory_human_readable = assemble(f.read())
+        simulator = Simulator(memory, memory_human_readable)
+        measurements += [
+            (f'step/{program}', partial(bench_step, simulator, n_steps, False)),
+            (f'step_history/{program}', partial(bench_step, simulator, n_steps, True)),
+            (f'revert/{program}', partial(bench_revert, simulator, n_steps)),
+        ]
+        if interface:
+            measurements.append((f'interface/{program}', partial(bench_interface, simulator, n_frames)))
+    measurements.append((f'assemble/{n_lines}_lines', partial(bench_assemble, generate_program(n_lines))))
+
+    results = dict()
+    for round_nr in range(repeat):
+        if verbose:
+            print(f'Round {round_nr + 1} of {repeat}...', file=sys.stderr, flush=True)
+        for name, measure in measurements:
+            value = measure()
+            _, higher_is_better = METRICS[name.split('/')[0]]
+            if name not in results or (value > results[name]) == higher_is_better:
+                results[name] = value
+    return results
+
+
+def _format_result(name, value):
+    """Format a single result for printing."""
+    unit, _ = METRICS[name.split('/')[0]]
+    return f'{name:40s} {value:14,.1f} {unit}'
+
+
+def compare(results, baseline, tolerance=0.1):
+    """Compare results against a baseline.
+
+    Parameters
+    ----------
+    results : dict of str -> float
+        The results, as produced by ``run_benchmarks()``.
+    baseline : dict of str -> float
+        The results of an earlier run.
+    tolerance : float
+        How much worse (as a fraction) a result can be than the baseline
+        before it is flagged as a regression. Defaults to 0.1 (10%).
+
+    Returns
+    -------
+    report : str
+        A human readable comparison.
+    regressions : list of str
+        The names of the results that regressed.
+    """
+    lines = [f'{"benchmark":40s} {"baseline":>14s} {"current":>14s} {"change":>8s}']
+    regressions = list()
+    for name in sorted(set(results) & set(baseline)):
+        unit, higher_is_better = METRICS[name.split('/')[0]]
+        old, new = baseline[name], results[name]
+        # Positive means better
+        change = (new - old) / old if higher_is_better else (old - new) / old
+        line = f'{name:40s} {old:14,.1f} {new:14,.1f} {100 * change:+7.1f}%'
+        if change < -tolerance:
+            line += '  REGRESSION'
+            regressions.append(name)
+        lines.append(line)
+    for name in sorted(set(results) ^ set(baseline)):
+        lines.append(f'{name:40s} only in {"current run" if name in results else "baseline"}')
+    return '\n'.join(lines), regressions
+
+
+def main(argv=None):
+    """Run the benchmarks from the command line.
+
+    Parameters
+    ----------
+    argv : list of str | None
+        The command line arguments. By default (``None``), these are taken from
+        ``sys.argv``.
+    """
+    parser = ArgumentParser(description=__doc__.split('\n\n')[1].replace('\n', ' '))
+    parser.add_argument('program_files', type=str, nargs='*', default=PROGRAMS,
+                        help='Programs to run, written in assembly language. Defaults to all programs in example_programs/.')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='Number of rounds of measurements. The best result of each measurement is kept. Defaults to 5.')
+    parser.add_argument('--steps', type=int, default=50_000,
+                        help='Number of steps (half clock-cycles) to take for each program. Defaults to 50 000.')
+    parser.add_argument('--lines', type=int, default=5_000,
+                        help='Number of lines of the generated program to assemble. Defaults to 5 000.')
+    parser.add_argument('--frames', type=int, default=1_000,
+                        help='Number of frames of the interface to draw for each program. Defaults to 1 000.')
+    parser.add_argument('--no-interface', action='store_true',
+                        help="Don't measure the interface, for example when the curses module is not available.")
+    parser.add_argument('-o', '--output', type=str, metavar='json_file', default=None,
+                        help='Write the results to this file in JSON format.')
+    parser.add_argument('--compare', type=str, metavar='json_file', default=None,
+                        help='Compare the results against a baseline, as written by --output. Exits with an error when any result is worse than the baseline by more than the tolerance.')
+    parser.add_argument('--tolerance', type=float, metavar='percent', default=10,
+                        help='How much worse than the baseline a result can be before it is flagged as a regression. Defaults to 10%%.')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        try:
+            with open(args.compare) as f:
+                baseline = json.load(f)['results']
+        except (OSError, ValueError, KeyError) as e:
+            parser.error(f'Could not load the baseline: {e}')
+
+    results = run_benchmarks(args.program_files, args.repeat, args.steps, args.lines, args.frames,
+                             interface=not args.no_interface, verbose=True)
+    if not args.compare:
+        for name, value in results.items():
+            print(_format_result(name, value))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(dict(
+                python=platform.python_version(),
+                implementation=platform.python_implementation(),
+                machine=platform.machine(),
+                settings=dict(repeat=args.repeat, steps=args.steps, lines=args.lines,
+                              frames=args.frames),
+                results=results,
+            ), f, indent=2)
+
+    if args.compare:
+        report, regressions = compare(results, baseline, args.tolerance / 100)
+        print()
+        print(report)
+        if regressions:
+            print(f'{len(regressions)} regression(s) of more than {args.tolerance:g}%.', file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+"""
+Breakpoints and watchpoints for the SAP-1 8-bit breadboard computer simulator.
+
+Breakpoints are written as text, in one of these forms:
+
+- ``12`` or ``loop``: break at the instruction at the given address or label
+- ``loop if A == 0 && flags.C``: break at an instruction when a condition holds
+- ``A == 0 && flags.C``: break at any instruction when a condition holds
+- ``write 14`` or ``write x``: break when the RAM address is written to
+
+Conditions are expressions that can use the registers ``A``, ``B``, ``ALU``,
+``bus``, ``PC``, ``MAR``, ``IR``, ``OUT``, ``step``, the flags ``C`` and ``Z``
+(or ``flags.C`` and ``flags.Z``), the RAM contents ``mem[address]``, the number
+of ``cycles`` and the labels of the program. They can be combined with ``&&``,
+``||`` and ``!`` (or Python's ``and``, ``or`` and ``not``).
+
+The breakpoints are only checked at the start of each instruction and when the
+RAM is written to, so the simulator keeps running at a good speed. When a
+condition cannot be evaluated (for example ``mem[A]`` when ``A`` is not a RAM
+address), the simulator stops as if the breakpoint was hit and reports the
+error.
+"""
+from collections import namedtuple
+import ast
+import re
+
+from observer import Observer
+from memory_backend import DEFAULT_ADDRESS_BITS
+
+# A single breakpoint. Either the address or the condition can be None.
+Breakpoint = namedtuple('Breakpoint', ['spec', 'address', 'condition', 'watch'])
+
+# The flags as they can be used in conditions
+Flags = namedtuple('Flags', ['C', 'Z'])
+
+# The names that can be used in conditions, besides the labels
+NAMES = {'A', 'B', 'ALU', 'bus', 'PC', 'MAR', 'IR', 'OUT', 'step', 'cycles',
+         'flags', 'C', 'Z', 'mem'}
+
+
+class Breakpoints(Observer):
+    """The set of breakpoints and watchpoints.
+
+    Attach it as an observer to the simulator (see observer.py). When a
+    breakpoint is hit, a description of it is stored in the ``hit``
+    attribute. The simulator checks this attribute at the next instruction
+    boundary and stops there.
+
+    Parameters
+    ----------
+    labels : dict of str -> int | None
+        The labels defined in the program, along with the memory address they
+        refer to, as produced by ``assemble(..., return_labels=True)``.
+    address_bits : int
+        The width of the memory address register, which determines the size
+        of the RAM. Defaults to 4 (16 bytes of RAM).
+    """
+    def __init__(self, labels=None, address_bits=DEFAULT_ADDRESS_BITS):
+        self.labels = dict() if labels is None else dict(labels)
+        self.address_bits = address_bits
+        self.breakpoints = list()
+        self.hit = None
+
+    def __len__(self):
+        return len(self.breakpoints)
+
+    def add(self, spec):
+        """Add a breakpoint.
+
+        Parameters
+        ----------
+        spec : str
+            The breakpoint, see the documentation at the top of this module.
+
+        Returns
+        -------
+        breakpoint : Breakpoint
+            The breakpoint that was added.
+        """
+        spec = spec.strip()
+        if spec.startswith('write '):
+            breakpoint = Breakpoint(spec, self._address(spec[len('write '):]), None, watch=True)
+        elif ' if ' in spec:
+            location, condition = spec.split(' if ', 1)
+            breakpoint = Breakpoint(spec, self._address(location), self._compile(condition), watch=False)
+        elif re.fullmatch(r'\w+', spec) and (spec.lower() in self.labels or spec not in NAMES):
+            breakpoint = Breakpoint(spec, self._address(spec), None, watch=False)
+        else:
+            breakpoint = Breakpoint(spec, None, self._compile(spec), watch=False)
+        self.breakpoints.append(breakpoint)
+        return breakpoint
+
+    def clear(self):
+        """Remove all breakpoints."""
+        self.breakpoints.clear()
+        self.hit = None
+
+    def _address(self, location):
+        """Translate an address or label to an address."""
+        location = location.strip()
+        if location.lower() in self.labels:
+            return self.labels[location.lower()]
+        try:
+            address = int(location, 0)
+        except ValueError:
+            raise ValueError(f'Not an address or label: {location}')
+        if not (0 <= address < 2 ** self.address_bits):
+            raise ValueError(f'Address out of range: {location}')
+        return address
+
+    def _compile(self, condition):
+        """Compile a condition into Python code."""
+        expression = condition.replace('&&', ' and ').replace('||', ' or ')
+        expression = re.sub(r'!(?!=)', ' not ', expression)
+        try:
+            tree = ast.parse(expression.strip(), '<breakpoint>', 'eval')
+            code = compile(tree, '<breakpoint>', 'eval')
+        except SyntaxError:
+            raise ValueError(f'Invalid condition: {condition}')
+        unknown = set(code.co_names) - NAMES - set(self.labels)
+        if unknown:
+            raise ValueError(f'Unknown name in condition: {", ".join(sorted(unknown))}')
+
+        # Check the RAM addresses that are known up front. Addresses that are
+        # computed from the registers can only be checked while running.
+        for node in ast.walk(tree):
+            if not (isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name)
+                    and node.value.id == 'mem'):
+                continue
+            if isinstance(node.slice, ast.Name) and node.slice.id in self.labels:
+                address = self.labels[node.slice.id]
+            else:
+                try:
+                    address = ast.literal_eval(node.slice)
+                except ValueError:
+                    continue
+            if not (isinstance(address, int) and 0 <= address < 2 ** self.address_bits):
+                raise ValueError(f'Address out of range: {ast.unparse(node)}')
+        return code
+
+    def _evaluate(self, condition, state):
+        """Evaluate a compiled condition on the current state."""
+        names = dict(self.labels)
+        names.update(
+            A=state.reg_a, B=state.reg_b, ALU=state.alu, bus=state.bus,
+            PC=state.reg_program_counter, MAR=state.reg_memory_address,
+            IR=state.reg_instruction, OUT=state.reg_output,
+            step=state.microinstruction_counter, cycles=state.cycles,
+            C=state.reg_flags & 1, Z=(state.reg_flags >> 1) & 1,
+            mem=state.memory,
+        )
+        names['flags'] = Flags(C=names['C'], Z=names['Z'])
+        return eval(condition, {'__builtins__': {}}, names)
+
+    def on_instruction_fetch(self, state, address):
+        for breakpoint in self.breakpoints:
+            if breakpoint.watch:
+                continue
+            if breakpoint.address is not None and breakpoint.address != address:
+                continue
+            if breakpoint.condition is not None:
+                # Stop rather than raise, so the error does not escape from
+                # the middle of a step.
+                try:
+                    if not self._evaluate(breakpoint.condition, state):
+                        continue
+                except Exception as e:
+                    self.hit = (f'Could not evaluate breakpoint "{breakpoint.spec}" '
+                                f'at PC {address}: {e}.')
+                    return
+            self.hit = f'Breakpoint "{breakpoint.spec}" hit at PC {address}.'
+            return
+
+    def on_ram_write(self, state, address, old, new):
+        for breakpoint in self.breakpoints:
+            if breakpoint.watch and breakpoint.address == address:
+                self.hit = (f'Watchpoint "{breakpoint.spec}" hit: RAM address {address} '
+                            f'changed from {old} to {new}.')
+                return
@@ -0,0 +1,25 @@
+;
+; Count down to zero, using the macros, constants and .org directive of the
+; assembler.
+;
+.const START = 5
+
+; Subtract the value at one memory address from the value at another
+.macro decrement address, amount
+	lda address
+	sub amount
+	sta address
+.endm
+
+	lda count
+loop:	out
+	decrement count, one
+	jz end
+	jmp loop
+end:	out
+	hlt
+
+; Keep the data at the end of the memory
+.org 14
+one:	db 1
+count:	db START
@@ -0,0 +1,249 @@
+"""
+Undo history for the simulator of the SAP-1 8-bit breadboard computer.
+
+Instead of keeping a full copy of the machine state for every step of the
+clock, only the registers that changed during the step are recorded, along with
+the RAM write (if any). This makes recording a step cheap and allows for a very
+long history within a modest memory budget. To go back even further, periodic
+checkpoints of the complete state are kept, from which the simulation can be
+re-run up to any earlier point in time.
+"""
+from array import array
+from collections import deque
+import sys
+
+import snapshot
+
+# By default, allow the history to grow to this many bytes.
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+# Estimated memory cost of a single history entry on top of the packed register
+# values: the bytes object holding them, plus the slot in the deque.
+_ENTRY_OVERHEAD = sys.getsizeof(b'') + 8
+
+# Additional cost of an entry that also records a RAM write.
+_RAM_WRITE_OVERHEAD = sys.getsizeof((0, 0, 0))
+
+
+class History:
+    """Bounded record of the changes made to the machine state.
+
+    Each entry records, for a single step of the clock, the old values of the
+    registers that were changed during that step and the old contents of the
+    RAM location that was written to (if any). When the memory budget is
+    exceeded, the oldest entries are discarded.
+
+    Parameters
+    ----------
+    max_bytes : int
+        The (approximate) maximum amount of memory the history may use.
+        Defaults to 64 MiB, which is enough for about a million steps.
+    """
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._entries = deque()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        """Forget everything."""
+        self._entries.clear()
+        self.nbytes = 0
+
+    def record(self, before, after, ram_write=None):
+        """Record the changes made during a single step.
+
+        Parameters
+        ----------
+        before : tuple of int
+            The values of the registers before the step.
+        after : tuple of int
+            The values of the registers after the step.
+        ram_write : tuple | None
+            If the RAM was written to during the step, a tuple
+            ``(address, old_contents)``.
+        """
+        # Pack (index, old value) pairs of the changed registers as 16-bit
+        # numbers. None of the registers are wider than that.
+        changes = array('H')
+        for index, (old, new) in enumerate(zip(before, after)):
+            if old != new:
+                changes.append(index)
+                changes.append(old)
+        entry = changes.tobytes()
+        if ram_write is not None:
+            entry = (entry, *ram_write)
+        self._entries.append(entry)
+
+        self.nbytes += _cost(entry)
+        while self.nbytes > self.max_bytes and len(self._entries) > 1:
+            self.nbytes -= _cost(self._entries.popleft())
+
+    def pop(self):
+        """Take the changes of the most recently recorded step.
+
+        Returns
+        -------
+        changes : list of (int, int)
+            For each register that was changed during the step, its index and
+            the value it had before the step.
+        ram_write : tuple | None
+            If the RAM was written to during the step, a tuple
+            ``(address, old_contents)``.
+        """
+        entry = self._entries.pop()
+        self.nbytes -= _cost(entry)
+        if isinstance(entry, tuple):
+            entry, *ram_write = entry
+        else:
+            ram_write = None
+        changes = array('H', entry)
+        return list(zip(changes[::2], changes[1::2])), ram_write
+
+
+def _cost(entry):
+    """Estimate the memory used by a history entry."""
+    if isinstance(entry, tuple):
+        return len(entry[0]) + _ENTRY_OVERHEAD + _RAM_WRITE_OVERHEAD
+    return len(entry) + _ENTRY_OVERHEAD
+
+
+class Timeline:
+    """Periodic checkpoints of the machine state, for going back in time.
+
+    To go back to an earlier point in time, the machine state is restored from
+    the closest checkpoint before that point, after which the simulation is
+    re-run up to that point. Since the machine is deterministic, this reproduces
+    the exact state at that time. To keep the memory usage bounded, the
+    interval between the checkpoints is doubled whenever there are too many of
+    them. The very first checkpoint is always kept, so any point in time can be
+    reached.
+
+    Points in time are counted in steps (half clock-cycles) and are obtained
+    through ``position()``.
+
+    Parameters
+    ----------
+    max_checkpoints : int
+        The maximum number of checkpoints to keep. Defaults to 1000.
+    interval : int
+        The initial number of steps between checkpoints. Defaults to 256.
+    """
+    def __init__(self, max_checkpoints=1000, interval=256):
+        self.max_checkpoints = max_checkpoints
+        self.interval = self._initial_interval = interval
+        self._checkpoints = dict()
+
+    def __len__(self):
+        return len(self._checkpoints)
+
+    def clear(self):
+        """Forget all checkpoints."""
+        self._checkpoints.clear()
+        self.interval = self._initial_interval
+
+    def record(self, state):
+        """Make a checkpoint of the state if it is time for one.
+
+        Parameters
+        ----------
+        state : State
+            The state of the machine as defined in simulator.py.
+        """
+        pos = position(state)
+        if pos % self.interval != 0 and len(self._checkpoints) > 0:
+            return
+        if pos in self._checkpoints:
+            return
+        self._checkpoints[pos] = snapshot.dumps(state)
+
+        if len(self._checkpoints) > self.max_checkpoints:
+            self.interval *= 2
+            first = min(self._checkpoints)
+            self._checkpoints = {pos: checkpoint for pos, checkpoint in self._checkpoints.items()
+                                 if pos == first or pos % self.interval == 0}
+
+    def goto(self, state, pos):
+        """Bring the machine to the given point in time.
+
+        Parameters
+        ----------
+        state : State
+            The state of the machine as defined in simulator.py.
+        pos : int
+            The point in time, which may be earlier or later than the current
+            one. When it is earlier than the first checkpoint, the machine is
+            brought to the first checkpoint instead.
+        """
+        # When the point in time is a little bit in the future, running forward
+        # from the current state is quickest.
+        if not (position(state) <= pos < position(state) + self.interval):
+            earlier = [p for p in self._checkpoints if p <= pos]
+            self._restore(state, max(earlier) if earlier else min(self._checkpoints))
+        while position(state) < pos and not state.halted:
+            _replay_step(state)
+
+    def find_last(self, state, condition):
+        """Find the last time a condition was met before the current time.
+
+        The simulation is re-run from the checkpoints, starting with the most
+        recent one and working backwards, until the condition is met. The state
+        of the machine is restored to the current time afterwards.
+
+        Parameters
+        ----------
+        state : State
+            The state of the machine as defined in simulator.py.
+        condition : callable
+            Function that is called after each step as ``condition(state,
+            microinstruction, output)`` with the state of the machine, the
+            microinstruction that was active during the step and the value
+            written to the output module during the step (if any). It should
+            return whether the condition is met.
+
+        Returns
+        -------
+        pos : int | None
+            The point in time right after the step during which the condition
+            was last met, or ``None`` if it was never met. This is always
+            earlier than the current time, so calling this repeatedly keeps
+            going further back.
+        """
+        now = position(state)
+        keep_history = state.keep_history
+        state.keep_history = False
+        checkpoints = sorted(p for p in self._checkpoints if p < now)
+        found = None
+        for start, end in reversed(list(zip(checkpoints, checkpoints[1:] + [now]))):
+            self._restore(state, start)
+            while position(state) < end and not state.halted:
+                microinstruction = state.microinstruction
+                output = _replay_step(state)
+                # A step that ends at the current time leaves the machine
+                # where it already is, so it does not count.
+                if condition(state, microinstruction, output) and position(state) < now:
+                    found = position(state)
+            if found is not None:
+                break
+        state.keep_history = keep_history
+        self.goto(state, now)
+        return found
+
+    def _restore(self, state, pos):
+        """Restore the state from the checkpoint at the given point in time."""
+        snapshot.loads(state, self._checkpoints[pos])
+
+
+def _replay_step(state):
+    """Perform a step of a part of the simulation that is being re-run. This
+    bypasses any observers (see observer.py), since they have seen these steps
+    before."""
+    return state.replay_step()
+
+
+def position(state):
+    """The point in time of the machine state, counted in steps (half
+    clock-cycles)."""
+    return 2 * state.cycles - state.clock
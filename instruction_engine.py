@@ -0,0 +1,223 @@
+"""
+Instruction-level simulator for the SAP-1 8-bit breadboard computer.
+
+Where the simulator in simulator.py is subcycle-accurate, this one only
+simulates the effect that each microinstruction has on the registers when the
+clock goes high, and runs a whole instruction at a time. The microcode EEPROM
+is decoded only once (see microcode.decode()), after which running a program
+is a lot faster. The architectural state (registers, flags, RAM, outputs) and
+the number of clock cycles are the same as in the subcycle-accurate simulator.
+
+Running this script performs a differential test of both simulators.
+"""
+import microcode
+from assembler import assemble, disassemble
+from memory_backend import create_ram, map_EEPROM, DEFAULT_ADDRESS_BITS
+
+# Registers that are part of the architectural state. These have the same name
+# in both simulators.
+ARCHITECTURAL_REGISTERS = (
+    'reg_a', 'reg_b', 'reg_instruction', 'reg_memory_address',
+    'reg_program_counter', 'reg_output', 'reg_flags', 'cycles',
+)
+
+
+class InstructionState:
+    """The state of the machine, as simulated one instruction at a time.
+
+    Parameters
+    ----------
+    memory : list of int
+        The initial contents of the RAM.
+    EEPROM : list of int | bytes | None
+        The binary contents of the EEPROMs to use as microcode. By default
+        (``None``) Ben Eater's original microcode is used.
+    early_reset : bool
+        Whether to reset the microinstruction counter as soon as the remaining
+        steps of an instruction are empty (see microcode.decode()). Defaults to
+        ``False``.
+    address_bits : int
+        The width of the memory address register and program counter, which
+        determines the size of the RAM. Defaults to 4 (16 bytes of RAM).
+    """
+    def __init__(self, memory, EEPROM=None, early_reset=False, address_bits=DEFAULT_ADDRESS_BITS):
+        if EEPROM is None:
+            EEPROM = microcode.EEPROM
+        self.microcode = microcode.decode(EEPROM, early_reset)
+        self.memory = create_ram(memory, address_bits)
+        self.address_mask = (1 << address_bits) - 1
+
+        self.bus = 0
+        self.reg_a = 0
+        self.reg_b = 0
+        self.reg_instruction = 0
+        self.reg_memory_address = 0
+        self.reg_program_counter = 0
+        self.reg_output = 0
+        self.reg_flags = 0
+
+        # The step of the current instruction that is to be executed next.
+        self.microinstruction_counter = 0
+        self.cycles = 0
+        self.halted = self._current_step().HLT
+
+    def _current_step(self):
+        """Get the decoded microinstruction that is currently active."""
+        rom_address = (
+            (self.reg_flags << 8) +
+            ((self.reg_instruction & 0xf0) >> 1) +
+            self.microinstruction_counter
+        )
+        return self.microcode[rom_address]
+
+    def step(self, max_cycles=None):
+        """Execute the remaining steps of the current instruction.
+
+        Parameters
+        ----------
+        max_cycles : int | None
+            Stop halfway the instruction when the total number of clock cycles
+            reaches this number. By default (``None``), there is no limit.
+
+        Returns
+        -------
+        outputs : tuple of (int, int)
+            The values written to the output module (usually none or one),
+            along with the clock cycle during which they were written.
+        """
+        outputs = tuple()
+        while not self.halted:
+            _, bus_source, readers, CE, RI, OI, II, FI, SU, HLT, next_step = self._current_step()
+
+            # Clock goes high
+            self.cycles += 1
+            if CE:
+                self.reg_program_counter = (self.reg_program_counter + 1) & self.address_mask
+
+            # The ALU has been computing while the clock was low
+            if SU:
+                alu = self.reg_a + (self.reg_b ^ 0xff) + 1
+            else:
+                alu = self.reg_a + self.reg_b
+
+            if bus_source == microcode.BUS_A:
+                self.bus = self.reg_a
+            elif bus_source == microcode.BUS_ALU:
+                self.bus = alu & 0xff
+            elif bus_source == microcode.BUS_INSTRUCTION:
+                self.bus = self.reg_instruction & 0x0f
+            elif bus_source == microcode.BUS_PC:
+                self.bus = self.reg_program_counter
+            elif bus_source == microcode.BUS_RAM:
+                self.bus = self.memory[self.reg_memory_address]
+
+            for register in readers:
+                setattr(self, register, self.bus)
+            self.reg_memory_address &= self.address_mask
+            self.reg_program_counter &= self.address_mask
+            if RI:
+                self.memory[self.reg_memory_address] = self.bus
+            if FI:
+                self.reg_flags = (alu > 0xff) + (((alu & 0xff) == 0) << 1)
+
+            # Changes of instruction and flags registers affect the control
+            # lines
+            if II or FI:
+                _, _, _, _, _, OI, _, _, _, HLT, next_step = self._current_step()
+            if OI:
+                outputs += ((self.cycles, self.reg_output),)
+            if HLT:
+                self.halted = True
+                break
+
+            # Clock goes low, advance to the next step
+            self.microinstruction_counter = next_step
+            self.halted = self._current_step().HLT
+            if self.microinstruction_counter == 0 or self.cycles == max_cycles:
+                break
+        return outputs
+
+
+def compare_engines(memory, EEPROM=None, max_instructions=10_000, address_bits=DEFAULT_ADDRESS_BITS):
+    """Run both simulators in lockstep and report where they first diverge.
+
+    Parameters
+    ----------
+    memory : list of int
+        The initial contents of the RAM.
+    EEPROM : list of int | bytes | None
+        The binary contents of the EEPROMs to use as microcode. By default
+        (``None``) Ben Eater's original microcode is used.
+    max_instructions : int
+        The maximum number of instructions to run. Defaults to 10 000.
+    address_bits : int
+        The width of the memory address register and program counter. Defaults
+        to 4 (16 bytes of RAM).
+
+    Returns
+    -------
+    divergence : str | None
+        A description of the first difference between the simulators, or
+        ``None`` if they agree.
+    """
+    from simulator import Simulator
+    subcycle = Simulator(memory, EEPROM=EEPROM, address_bits=address_bits).state
+    subcycle.keep_history = False
+    instruction = InstructionState(memory, EEPROM, address_bits=address_bits)
+
+    for instruction_nr in range(max_instructions):
+        pc = subcycle.reg_program_counter
+        try:
+            asm = disassemble(subcycle.memory[pc])
+        except (IndexError, KeyError):
+            asm = '?'
+        outputs_subcycle = subcycle.step_instruction()
+        outputs_instruction = instruction.step()
+
+        differences = [
+            f'{name}: {getattr(subcycle, name)} != {getattr(instruction, name)}'
+            for name in ARCHITECTURAL_REGISTERS
+            if getattr(subcycle, name) != getattr(instruction, name)
+        ]
+        if subcycle.memory != instruction.memory:
+            differences.append(f'memory: {list(subcycle.memory)} != {list(instruction.memory)}')
+        if outputs_subcycle != outputs_instruction:
+            differences.append(f'outputs: {outputs_subcycle} != {outputs_instruction}')
+        if subcycle.halted != instruction.halted:
+            differences.append(f'halted: {subcycle.halted} != {instruction.halted}')
+        if differences:
+            return (f'Instruction #{instruction_nr} at address {pc} ({asm}), '
+                    f'cycle {subcycle.cycles}: ' + ', '.join(differences))
+        if subcycle.halted:
+            break
+    return None
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description='Differential test of the subcycle-accurate and instruction-level simulators.')
+    parser.add_argument('program_files', type=str, nargs='+', help='Programs to execute, written in assembly language.')
+    parser.add_argument('-m', '--microcode', type=str, metavar='bin_file', default=None,
+                        help='EEPROM content to use as microcode (as a binary memory dump). Defaults to Ben Eaters original microcode.')
+    parser.add_argument('-i', '--max-instructions', type=int, default=10_000,
+                        help='Maximum number of instructions to run for each program. Defaults to 10 000.')
+    args = parser.parse_args()
+
+    if args.microcode:
+        EEPROM = map_EEPROM(args.microcode)
+    else:
+        EEPROM = None
+
+    all_ok = True
+    for program_file in args.program_files:
+        with open(program_file) as f:
+            memory, _ = assemble(f.read())
+        divergence = compare_engines(memory, EEPROM, args.max_instructions)
+        if divergence is None:
+            print(f'{program_file}: OK')
+        else:
+            print(f'{program_file}: {divergence}')
+            all_ok = False
+    if not all_ok:
+        raise SystemExit(1)
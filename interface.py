@@ -22,29 +22,36 @@ schematic = """
    ┠────────────────────────────────┨ └──────────┨          LIIOOIIOOUIIEO I    ┃
    ┃ 00                             ┃            ┃          T                   ┃
    ┃ 01                             ┃            ┗━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┛
-   ┃ 02                             ┃
-   ┃ 03                             ┃
-   ┃ 04                             ┃            ┏━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┓
-   ┃ 05                             ┃            ┃ Keyboard commands             ┃            
-   ┃ 06                             ┃            ┠───────────────────────────────┨            
-   ┃ 07                             ┃            ┃ Space: start/stop clock       ┃            
-   ┃ 08                             ┃            ┃     →: step clock             ┃            
-   ┃ 09                             ┃            ┃     ←: step clock backwards   ┃
-   ┃ 10                             ┃            ┃     ↑: increase clock speed   ┃
-   ┃ 11                             ┃            ┃     ↓: decrease clock speed   ┃
+   ┃ 02                             ┃            ┏━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┓
+   ┃ 03                             ┃            ┃ Keyboard commands             ┃
+   ┃ 04                             ┃            ┠───────────────────────────────┨
+   ┃ 05                             ┃            ┃ Space: start/stop clock       ┃
+   ┃ 06                             ┃            ┃   →/←: step clock fwd/back    ┃
+   ┃ 07                             ┃            ┃   ↑/↓: inc./dec. clock speed  ┃
+   ┃ 08                             ┃            ┃ Enter: run until next instr.  ┃
+   ┃ 09                             ┃            ┃     b: set breakpoint         ┃
+   ┃ 10                             ┃            ┃     p: back to prev. output   ┃
+   ┃ 11                             ┃            ┃     w: back to prev. write    ┃
    ┃ 12                             ┃            ┃     o: toggle output mode     ┃
    ┃ 13                             ┃            ┃     r: reset system           ┃
-   ┃ 14                             ┃            ┃ Enter: run until next instr.  ┃
+   ┃ 14                             ┃            ┃     s: save state             ┃
    ┃ 15                             ┃            ┃   ESC: quit                   ┃
    ┗━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┛            ┗━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┛
 """
 
 import curses
 import sys
-from time import time, sleep
 
 import microcode
 from assembler import disassemble
+from worker import SimulatorWorker
+
+# The maximum number of times per second the screen is updated.
+MAX_FPS = 30
+
+# What was last drawn at each position on the screen, so only the parts that
+# changed need to be drawn again.
+_drawn = dict()
 
 
 def init(stdscr):
@@ -74,11 +81,23 @@ def init(stdscr):
     # update() function.
     stdscr.clear()
     stdscr.addstr(0, 0, schematic, curses.color_pair(1))
+    _drawn.clear()
+
+
+def _changed(row, col, *what):
+    """Check whether what is to be drawn at a position on the screen differs from
+    what was last drawn there. If so, it is remembered for next time."""
+    if _drawn.get((row, col)) == what:
+        return False
+    _drawn[row, col] = what
+    return True
 
 
 def update(stdscr, state):
     """Update the console user interface.
 
+    Only the parts of the screen that changed since the last update are drawn.
+
     Parameters
     ----------
     stdscr : curses screen
@@ -107,6 +126,8 @@ def update(stdscr, state):
         dec : bool
             Whether to also display the number in decimal. Defaults to True.
         """
+        if not _changed(row, col, num, color, n, dec):
+            return
         for i in range(n):
             led_color = color if (num >> i) & 1 else 1
             stdscr.addstr(row, col + n - 1 - i, '●', curses.color_pair(led_color))
@@ -141,25 +162,28 @@ def update(stdscr, state):
     draw_leds(11, 17, num=state.reg_instruction >> 4, n=4, color=4)
     draw_leds(11, 21, num=state.reg_instruction & 0x0f, n=4, color=5)
     # Print the assembler instruction (clear the line first)
-    stdscr.addstr(12, 17, '         ', curses.color_pair(1))
-    stdscr.addstr(12, 17, f'({disassemble(state.reg_instruction)})', curses.color_pair(1))
+    if _changed(12, 17, state.reg_instruction):
+        stdscr.addstr(12, 17, '         ', curses.color_pair(1))
+        stdscr.addstr(12, 17, f'({disassemble(state.reg_instruction)})', curses.color_pair(1))
 
     # "B" register
     draw_leds(12, 65, num=state.reg_b, n=8, color=2)
 
     # Output register
-    if state.output_signed_mode:
-        # Convert 8bit twos-complement number to a Python signed integer
-        out = state.reg_output
-        if out & 0x80:
-            out = (out ^ 0xff) - 1
-        stdscr.addstr(15, 59, f'{out:04d} (signed)  ', curses.color_pair(2))
-    else:
-        stdscr.addstr(15, 59, f'{state.reg_output:04d} (unsigned)', curses.color_pair(2))
+    if _changed(15, 59, state.reg_output, state.output_signed_mode):
+        if state.output_signed_mode:
+            # Convert 8bit twos-complement number to a Python signed integer
+            out = state.reg_output
+            if out & 0x80:
+                out = (out ^ 0xff) - 1
+            stdscr.addstr(15, 59, f'{out:04d} (signed)  ', curses.color_pair(2))
+        else:
+            stdscr.addstr(15, 59, f'{state.reg_output:04d} (unsigned)', curses.color_pair(2))
 
     # Microinstruction step
     draw_leds(15, 17, num=state.microinstruction_counter, n=3, color=2, dec=False)
-    stdscr.addstr(15, 27, f'({state.microinstruction_counter:03d})', curses.color_pair(1))
+    if _changed(15, 27, state.microinstruction_counter):
+        stdscr.addstr(15, 27, f'({state.microinstruction_counter:03d})', curses.color_pair(1))
 
     step = 0b11111
     step -= 0b10000 >> state.microinstruction_counter
@@ -178,67 +202,124 @@ def update(stdscr, state):
             color = curses.color_pair(3)
         if address == state.reg_memory_address:
             color = curses.color_pair(5)
+        if not _changed(21 + address, 4, contents, color):
+            continue
 
         # Blank the line before drawing memory contents
         stdscr.addstr(21 + address, 4, '                               ', color)
         stdscr.addstr(21 + address, 5, contents, color)
 
-    # Halt message
-    if state.control_signals & microcode.HLT:
+    # Halt message (unless it is already shown)
+    if state.control_signals & microcode.HLT and (39, 0) not in _drawn:
         print_message(stdscr, 'System halted.')
+        _drawn[39, 0] = 'System halted.'
 
     # Do the actual drawing to the screen
     stdscr.refresh()
 
 
+def draw_clock_speed(stdscr, hz):
+    """Show the measured clock speed next to the clock LED.
+
+    Parameters
+    ----------
+    stdscr : curses screen
+        The curses screen object as created by curses.wrapper().
+    hz : float | None
+        The clock speed in Hz. When ``None``, the clock speed is cleared.
+    """
+    text = '' if hz is None else f'({hz:,.0f} Hz)'
+    if _changed(2, 15, text):
+        stdscr.addstr(2, 15, text.ljust(20), curses.color_pair(1))
+
+
 def print_message(stdscr, msg):
+    _drawn.pop((39, 0), None)
     stdscr.move(39, 0)
     stdscr.clrtoeol()
     stdscr.addstr(39, 0, msg, curses.color_pair(1))
     stdscr.refresh()
 
 
-def handle_keypresses(stdscr, simulator):
+def ask(stdscr, question):
+    """Ask the user to type something at the bottom of the screen.
+
+    Parameters
+    ----------
+    question : str
+        The question to ask.
+
+    Returns
+    -------
+    answer : str
+        The answer typed by the user.
+    """
+    print_message(stdscr, question)
+    curses.cbreak()
+    stdscr.nodelay(False)
+    curses.echo()
+    curses.curs_set(1)
+    try:
+        return stdscr.getstr(39, len(question) + 1, curses.COLS - len(question) - 2).decode()
+    finally:
+        curses.noecho()
+        curses.curs_set(0)
+
+
+def handle_keypresses(stdscr, worker, save_state_file=None):
     """Handle user keypresses.
 
     Parameters
     ----------
-    simulator : Simulator
-        The simulator objet running the show.
+    worker : SimulatorWorker
+        The worker thread running the simulator.
+    save_state_file : str | None
+        The file to save the state of the machine to when requested.
     """
     try:
         c = stdscr.getch()
         if c == ord(' '):
-            simulator.clock_automatic = not simulator.clock_automatic
-            if simulator.clock_automatic:
-                print_message(stdscr, 'Started clock.')
-            else:
-                print_message(stdscr, 'Stopped clock.')
+            # The snapshot may not reflect earlier keypresses yet, so let the
+            # worker decide the new settings of the clock.
+            worker.send('toggle_run')
         elif c == curses.KEY_RIGHT:
             print_message(stdscr, 'Stepping clock.')
-            simulator.step()
+            worker.send('step')
         elif c == curses.KEY_LEFT:
             print_message(stdscr, 'Stepping clock backwards.')
-            simulator.state.revert()
+            worker.send('step_back')
         elif c == curses.KEY_UP:
-            simulator.clock_speed *= 2
-            print_message(stdscr, f'Increased clock to {simulator.clock_speed} Hz.')
+            worker.send('scale_speed', 2)
         elif c == curses.KEY_DOWN:
-            simulator.clock_speed /= 2
-            if simulator.clock_speed < 0:
-                simulator.clock_speed = 0
-            print_message(stdscr, f'Decreased clock to {simulator.clock_speed} Hz.')
+            worker.send('scale_speed', 0.5)
         elif c == ord('\n'):
-            simulator.step()
-            while (simulator.state.microinstruction_counter > 0 or not simulator.state.clock) and not simulator.state.control_signals & microcode.HLT:
-                simulator.step()
+            worker.send('next_instruction')
             print_message(stdscr, 'Stepping clock until we reach next instruction.')
+        elif c == ord('p'):
+            worker.send('reverse_to_output')
+        elif c == ord('w'):
+            answer = ask(stdscr, 'Go back to the previous write of address:')
+            try:
+                worker.send('reverse_to_write', int(answer, 0))
+            except ValueError:
+                print_message(stdscr, f'Not an address: {answer}')
+        elif c == ord('b'):
+            answer = ask(stdscr, 'Break at (empty to remove all):')
+            if answer.strip():
+                worker.send('add_breakpoint', answer)
+            else:
+                worker.send('clear_breakpoints')
         elif c == ord('o'):
-            simulator.state.output_signed_mode = not simulator.state.output_signed_mode
-            update(stdscr, simulator.state)
+            worker.send('toggle_output_mode')
         elif c == ord('r'):
-            simulator.reset()
+            worker.send('reset')
+        elif c == ord('s'):
+            if save_state_file is None:
+                print_message(stdscr, 'Use the --save-state option to specify a file to save the state to.')
+            else:
+                worker.send('save_state', save_state_file)
         elif c == 27 or c == ord('q') or c == 3:
+            worker.send('quit')
             sys.exit(0)
     except curses.error as e:
         # No key pressed
@@ -247,43 +328,37 @@ def handle_keypresses(stdscr, simulator):
         stdscr.addstr(38, 0, str(e))
 
 
-def run_interface(stdscr, simulator):
+def run_interface(stdscr, simulator, save_state_file=None):
     """Main function to run the simulator with its console user interface.
 
+    The simulator runs in a separate thread (see worker.py). This function
+    only handles drawing the screen and passing on the keypresses.
+
     Parameters
     ----------
     stdscr : curses screen
         The curses screen object as created by curses.wrapper().
     simulator : Simulator
         The 8-bit breadboard CPU simulator.
+    save_state_file : str | None
+        The file to save the state of the machine to when the user presses
+        "s". By default (``None``), saving the state is not possible.
     """
     init(stdscr)
+    worker = SimulatorWorker(simulator)
+    worker.start()
 
-    # Start simulation and UI loop. This loop only terminates when the ESC
-    # key is pressed, which is detected inside the handle_keypresses()
-    # function.
+    # Start the UI loop. This loop only terminates when the ESC key is
+    # pressed, which is detected inside the handle_keypresses() function.
+    # Waiting for a keypress times out when it is time to draw the next
+    # frame.
     while True:
-        update(stdscr, simulator.state)
-        if simulator.clock_automatic:
-            wait_time = (0.5 / simulator.clock_speed) - (time() - simulator.last_clock_time)
-            if wait_time > 0.1:
-                curses.halfdelay(int(10 * wait_time))
-                handle_keypresses(stdscr, simulator)
-                simulator.step()
-            else:
-                curses.nocbreak()
-                if wait_time > 0:
-                    sleep(wait_time)
-                curses.nocbreak()
-                stdscr.nodelay(True)
-                handle_keypresses(stdscr, simulator)
-                simulator.step()
-        else:
-            curses.cbreak()
-            handle_keypresses(stdscr, simulator)
-
-        # When we reach the end of the program, set the clock to manual
-        # mode so we don't keep generating useless system states.
-        if simulator.state.control_signals & microcode.HLT:
-            simulator.clock_automatic = False
-        update(stdscr, simulator.state)
+        snapshot = worker.snapshot
+        draw_clock_speed(stdscr, snapshot.measured_clock_speed)
+        update(stdscr, snapshot)
+        while not worker.messages.empty():
+            print_message(stdscr, worker.messages.get())
+
+        curses.cbreak()
+        stdscr.timeout(1000 // MAX_FPS)
+        handle_keypresses(stdscr, worker, save_state_file)
@@ -0,0 +1,125 @@
+"""
+Storage for the RAM and microcode EEPROM of the SAP-1 8-bit breadboard
+computer simulator.
+
+The RAM of the original computer has 16 addresses, selected by a 4-bit memory
+address register and program counter. Expanded builds widen these registers to
+address more RAM. Since they are loaded from the 8-bit bus, they can be at most
+8 bits wide, giving 256 bytes of RAM.
+
+The simulator only reads and writes single addresses of the RAM, so any mutable
+sequence of bytes can be used to store it. The following backends are
+available:
+
+- ``'list'``: a Python list of ints
+- ``'bytearray'``: compact storage, using one byte for each address
+- ``'mmap'``: a RAM image file that is mapped into memory. Everything the
+  simulator writes to the RAM shows up in the file right away, so the RAM can
+  be inspected by other processes (for example with ``xxd``) while the
+  simulator is running.
+"""
+import mmap
+import os
+
+# The width of the memory address register and program counter of the original
+# computer, and the maximum width that can be loaded from the bus.
+DEFAULT_ADDRESS_BITS = 4
+MAX_ADDRESS_BITS = 8
+
+# The available ways of storing the RAM
+BACKENDS = ('list', 'bytearray', 'mmap')
+
+# The size of an EEPROM image holding the microcode
+EEPROM_SIZE = 1024
+
+
+def check_address_bits(address_bits):
+    """Make sure an address width is supported.
+
+    Parameters
+    ----------
+    address_bits : int
+        The width of the memory address register and program counter.
+    """
+    if not 1 <= address_bits <= MAX_ADDRESS_BITS:
+        raise ValueError(f'The address width should be between 1 and {MAX_ADDRESS_BITS} bits.')
+
+
+def create_ram(contents=(), address_bits=DEFAULT_ADDRESS_BITS, backend='bytearray', filename=None):
+    """Create the RAM of the machine.
+
+    Parameters
+    ----------
+    contents : list of int | bytes
+        The initial contents of the RAM, starting at address 0. The remaining
+        addresses are filled with zeros.
+    address_bits : int
+        The width of the memory address register and program counter. The RAM
+        has ``2 ** address_bits`` addresses. Defaults to 4, like the original
+        computer.
+    backend : 'list' | 'bytearray' | 'mmap'
+        How to store the RAM, see the documentation at the top of this module.
+        Defaults to ``'bytearray'``.
+    filename : str | None
+        When using the ``'mmap'`` backend, the RAM image file. It is created
+        when it does not exist yet and its contents are replaced by the initial
+        contents of the RAM. By default (``None``), an anonymous memory map is
+        used, which cannot be inspected from the outside.
+
+    Returns
+    -------
+    ram : list of int | bytearray | memoryview
+        The RAM. For the ``'mmap'`` backend, this is a view on the memory map.
+    """
+    check_address_bits(address_bits)
+    if backend not in BACKENDS:
+        raise ValueError(f'Invalid RAM backend: {backend}')
+    if filename is not None and backend != 'mmap':
+        raise ValueError('A RAM image file can only be used with the mmap backend.')
+    size = 1 << address_bits
+    if len(contents) > size:
+        raise ValueError(f'The program is {len(contents)} bytes long, '
+                         f'which does not fit in {size} bytes of RAM.')
+    image = bytes(contents) + bytes(size - len(contents))
+
+    if backend == 'list':
+        return list(image)
+    elif backend == 'bytearray':
+        return bytearray(image)
+
+    if filename is None:
+        ram = mmap.mmap(-1, size)
+    else:
+        # Don't truncate the file first, so processes that have it mapped
+        # never see it shrink.
+        fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            os.ftruncate(fd, size)
+            ram = mmap.mmap(fd, size, access=mmap.ACCESS_WRITE)
+        finally:
+            os.close(fd)
+    ram[:] = image
+    # Unlike the map itself, a view on it produces ints when iterated over, just
+    # like the other backends.
+    return memoryview(ram)
+
+
+def map_EEPROM(filename):
+    """Map an EEPROM image file into memory, without copying its contents.
+
+    Parameters
+    ----------
+    filename : str
+        The file containing the EEPROM contents (as a binary memory dump).
+
+    Returns
+    -------
+    EEPROM : memoryview
+        A read-only view on the contents of the EEPROM.
+    """
+    with open(filename, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size != EEPROM_SIZE:
+            raise ValueError(f'{filename} is {size} bytes long, '
+                             f'but an EEPROM image should be {EEPROM_SIZE} bytes.')
+        return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
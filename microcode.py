@@ -2,9 +2,10 @@
 Python translation of Ben Eater's original EEPROM arduino sketch
 https://github.com/beneater/eeprom-programmer/blob/master/microcode-eeprom-with-flags/microcode-eeprom-with-flags.ino
 """
-from argparse import ArgumentParser
-from copy import deepcopy
+from collections import namedtuple
+import os
 import struct
+import zlib
 
 HLT = 0b1000000000000000  # Halt clock
 MI  = 0b0100000000000000  # Memory address register in
@@ -23,6 +24,10 @@ CO  = 0b0000000000000100  # Program counter out
 J   = 0b0000000000000010  # Jump (program counter in)
 FI  = 0b0000000000000001  # Flags in
 
+# Number of steps of each instruction. After this, the microinstruction
+# counter resets.
+NUM_STEPS = 5
+
 FLAGS_Z0C0 = 0
 FLAGS_Z0C1 = 1
 FLAGS_Z1C0 = 2
@@ -50,40 +55,419 @@ UCODE_TEMPLATE = [
     [MI|CO,  RO|II|CE,  HLT,    0,      0,           0, 0, 0],   # 1111 - HLT
 ]
 
-# initUCode
-ucode = [deepcopy(UCODE_TEMPLATE) for _ in range(4)]
-ucode[FLAGS_Z0C1][JC][2] = IO|J
-ucode[FLAGS_Z1C0][JZ][2] = IO|J
-ucode[FLAGS_Z1C1][JC][2] = IO|J
-ucode[FLAGS_Z1C1][JZ][2] = IO|J
-
-# Contents of the EEPROM
-EEPROM = [0] * 1024
-
-# Program the 8 high-order bits of microcode into the first 128 bytes of EEPROM
-for address in range(1024):
-    flags       = (address & 0b1100000000) >> 8
-    byte_sel    = (address & 0b0010000000) >> 7
-    instruction = (address & 0b0001111000) >> 3
-    step        = (address & 0b0000000111)
-
-    if byte_sel:
-        EEPROM[address] = ucode[flags][instruction][step] & 0xff
+
+def build_ucode():
+    """Build the microcode for each combination of the flags from the
+    template (initUCode in the original sketch).
+
+    Returns
+    -------
+    ucode : list of list of list of int
+        The control word of each step of each instruction, for each
+        combination of the flags.
+    """
+    ucode = [[list(steps) for steps in UCODE_TEMPLATE] for _ in range(4)]
+    ucode[FLAGS_Z0C1][JC][2] = IO|J
+    ucode[FLAGS_Z1C0][JZ][2] = IO|J
+    ucode[FLAGS_Z1C1][JC][2] = IO|J
+    ucode[FLAGS_Z1C1][JZ][2] = IO|J
+    return ucode
+
+
+def build_EEPROM(ucode):
+    """Program the microcode into the EEPROMs.
+
+    Parameters
+    ----------
+    ucode : list of list of list of int
+        The microcode, as produced by ``build_ucode()``.
+
+    Returns
+    -------
+    EEPROM : list of int
+        The binary contents of the EEPROMs, 1024 bytes in length.
+    """
+    EEPROM = [0] * 1024
+
+    # Program the 8 high-order bits of microcode into the first 128 bytes of EEPROM
+    for address in range(1024):
+        flags       = (address & 0b1100000000) >> 8
+        byte_sel    = (address & 0b0010000000) >> 7
+        instruction = (address & 0b0001111000) >> 3
+        step        = (address & 0b0000000111)
+
+        if byte_sel:
+            EEPROM[address] = ucode[flags][instruction][step] & 0xff
+        else:
+            EEPROM[address] = ucode[flags][instruction][step] >> 8
+    return EEPROM
+
+
+def opcode_name(opcode):
+    """Get the name of an opcode, or its binary representation if it has no
+    name."""
+    from assembler import num_to_instruction
+    return num_to_instruction.get(opcode, f'{opcode:04b}')
+
+
+def eeprom_hash(EEPROM):
+    """Compute the hash of the contents of the microcode EEPROM, which
+    identifies a version of the microcode.
+
+    Parameters
+    ----------
+    EEPROM : list of int | bytes
+        The binary contents of the EEPROMs.
+
+    Returns
+    -------
+    hash : bytes
+        The 16-byte hash.
+    """
+    # Only imported when needed, since it takes a while
+    import hashlib
+    return hashlib.blake2b(bytes(EEPROM), digest_size=16).digest()
+
+
+def _cache_file():
+    """Get the file in which the EEPROM contents are cached. The name contains
+    a checksum of this source file, so changing the microcode invalidates the
+    cache."""
+    with open(__file__, 'rb') as f:
+        checksum = zlib.crc32(f.read())
+    cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_dir, '8bit', f'microcode-{checksum:08x}.bin')
+
+
+def load_EEPROM():
+    """Get the contents of the EEPROM. They are read from the cache on disk
+    when possible, otherwise they are built and stored in the cache.
+
+    Returns
+    -------
+    EEPROM : list of int
+        The binary contents of the EEPROMs, 1024 bytes in length.
+    """
+    try:
+        cache_file = _cache_file()
+    except OSError:
+        cache_file = None
+
+    if cache_file is not None:
+        try:
+            with open(cache_file, 'rb') as f:
+                contents = f.read()
+            if len(contents) == 1024:
+                return list(contents)
+        except OSError:
+            pass
+
+    EEPROM = build_EEPROM(build_ucode())
+    if cache_file is not None:
+        try:
+            # Write to a temporary file first, so other processes never read
+            # a partially written cache file.
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            temp_file = f'{cache_file}.{os.getpid()}'
+            with open(temp_file, 'wb') as f:
+                f.write(bytes(EEPROM))
+            os.replace(temp_file, cache_file)
+        except OSError:
+            # Without a cache, the EEPROM is simply built every time
+            pass
+    return EEPROM
+
+
+def __getattr__(name):
+    """Build ``ucode`` and the contents of the ``EEPROM`` when they are first
+    used, rather than on import."""
+    if name == 'ucode':
+        value = build_ucode()
+    elif name == 'EEPROM':
+        value = load_EEPROM()
     else:
-        EEPROM[address] = ucode[flags][instruction][step] >> 8
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    globals()[name] = value
+    return value
+
+
+# Possible sources of the value on the bus
+BUS_NONE, BUS_A, BUS_ALU, BUS_INSTRUCTION, BUS_PC, BUS_RAM = range(6)
+
+# The control signals that write to the bus
+_BUS_WRITERS = [('AO', AO), ('EO', EO), ('IO', IO), ('CO', CO), ('RO', RO)]
+
+# For each control signal that reads from the bus, the register it writes to.
+# These are listed in the order in which they are read by the simulator.
+_BUS_READERS = [
+    (AI, 'reg_a'),
+    (BI, 'reg_b'),
+    (II, 'reg_instruction'),
+    (MI, 'reg_memory_address'),
+    (J, 'reg_program_counter'),
+    (OI, 'reg_output'),
+]
+
+# A decoded control word
+MicroInstruction = namedtuple('MicroInstruction', [
+    'control_word',  # The 16-bit control word
+    'bus_source',    # Which component writes to the bus (one of BUS_...)
+    'readers',       # Names of the registers that read from the bus
+    'CE', 'RI', 'OI', 'II', 'FI', 'SU', 'HLT',
+    'next_step',     # The step that follows when the clock goes low
+])
+
+# Decoded microcode for each EEPROM image that has been used so far.
+_decoded = dict()
+
+
+def decode(EEPROM, early_reset=False):
+    """Decode the EEPROM contents into a table of microinstructions.
+
+    The table is built only once for each EEPROM image.
+
+    Parameters
+    ----------
+    EEPROM : list of int | bytes
+        The binary contents of the EEPROMs to use as microcode, should be 1024
+        bytes in length.
+    early_reset : bool
+        Whether the microinstruction counter resets as soon as the remaining
+        steps of an instruction don't assert any control signals, rather than
+        always after NUM_STEPS steps. Defaults to ``False``.
+
+    Returns
+    -------
+    table : list of MicroInstruction
+        For each ROM address, the decoded control word. The control word is
+        formed by combining two EEPROMs with identical contents. The 7'th
+        address line is tied high on the first EEPROM and tied low on the
+        second. Hence, it does not matter whether that bit of the ROM address
+        is set.
+    """
+    key = (bytes(EEPROM), early_reset)
+    if key in _decoded:
+        return _decoded[key]
+
+    control_words = [(EEPROM[rom_address & ~(1 << 7)] << 8) + (EEPROM[rom_address | (1 << 7)] & 0xff)
+                     for rom_address in range(1024)]
+
+    # Only a handful of different control words are used, so each is decoded
+    # only once.
+    microinstructions = dict()
+    table = list()
+    for rom_address, control_word in enumerate(control_words):
+        step = rom_address & 0b111
+        next_step = (step + 1) % NUM_STEPS
+        if early_reset and not any(control_words[rom_address - step + s] for s in range(step + 1, NUM_STEPS)):
+            next_step = 0
+        if (control_word, next_step) in microinstructions:
+            table.append(microinstructions[control_word, next_step])
+            continue
+
+        # When multiple components write to the bus, the last one wins.
+        bus_source = BUS_NONE
+        for signal, source in [(AO, BUS_A), (EO, BUS_ALU), (IO, BUS_INSTRUCTION),
+                               (CO, BUS_PC), (RO, BUS_RAM)]:
+            if control_word & signal:
+                bus_source = source
+
+        readers = tuple(reg for signal, reg in _BUS_READERS if control_word & signal)
+        microinstruction = MicroInstruction(
+            control_word, bus_source, readers,
+            *[bool(control_word & signal) for signal in [CE, RI, OI, II, FI, SU, HLT]],
+            next_step,
+        )
+        microinstructions[control_word, next_step] = microinstruction
+        table.append(microinstruction)
+
+    _decoded[key] = table
+    return table
+
+
+def table_from_EEPROM(EEPROM):
+    """Read the microcode back from the EEPROM contents.
+
+    Parameters
+    ----------
+    EEPROM : list of int | bytes
+        The binary contents of the EEPROMs, should be 1024 bytes in length.
+
+    Returns
+    -------
+    ucode : list of list of list of int
+        The control word of each step of each instruction for each combination
+        of the flags, in the same layout as ``ucode``.
+    """
+    table = decode(EEPROM)
+    return [[[table[(flags << 8) + (instruction << 3) + step].control_word for step in range(8)]
+             for instruction in range(16)]
+            for flags in range(4)]
+
+
+def find_bus_conflicts(ucode):
+    """Find the steps in which more than one component writes to the bus.
+
+    Parameters
+    ----------
+    ucode : list of list of list of int
+        The control word of each step of each instruction for each combination
+        of the flags, like ``ucode``.
+
+    Returns
+    -------
+    conflicts : list of (int, int, int, list of str)
+        For each conflict, the flags, instruction, step and the names of the
+        signals that write to the bus.
+    """
+    conflicts = list()
+    for flags, instructions in enumerate(ucode):
+        for instruction, steps in enumerate(instructions):
+            for step, control_word in enumerate(steps[:NUM_STEPS]):
+                writers = [name for name, signal in _BUS_WRITERS if control_word & signal]
+                if len(writers) > 1:
+                    conflicts.append((flags, instruction, step, writers))
+    return conflicts
+
+
+def find_trailing_empty_steps(ucode):
+    """Find the instructions that end with steps that don't assert any control
+    signals. These steps waste clock cycles, unless the microinstruction
+    counter is reset early (see ``decode()``).
+
+    Parameters
+    ----------
+    ucode : list of list of list of int
+        The control word of each step of each instruction for each combination
+        of the flags, like ``ucode``.
+
+    Returns
+    -------
+    lengths : list of (int, int, int)
+        For each instruction that can be shortened, the flags, instruction and
+        the number of steps that remain when the empty steps at the end are
+        skipped.
+    """
+    lengths = list()
+    for flags, instructions in enumerate(ucode):
+        for instruction, steps in enumerate(instructions):
+            length = NUM_STEPS
+            while length > 1 and steps[length - 1] == 0:
+                length -= 1
+            if length < NUM_STEPS:
+                lengths.append((flags, instruction, length))
+    return lengths
+
+
+def compare_early_reset(program_file, EEPROM=None, max_cycles=10_000):
+    """Run a program with and without resetting the microinstruction counter
+    early, to find out how many clock cycles it saves.
+
+    Parameters
+    ----------
+    program_file : str
+        The program to run, written in assembly language.
+    EEPROM : list of int | bytes | None
+        The binary contents of the EEPROMs to use as microcode. By default
+        (``None``) Ben Eater's original microcode is used.
+    max_cycles : int
+        Stop the program after this number of clock cycles. Defaults to
+        10 000.
+
+    Returns
+    -------
+    results : tuple of RunResult
+        The result of running the program normally and with early reset.
+    """
+    from assembler import assemble
+    from simulator import Simulator
+    with open(program_file) as f:
+        memory, _ = assemble(f.read())
+    return tuple(Simulator(list(memory), EEPROM=EEPROM, engine='instruction', early_reset=early_reset)
+                 .run(max_cycles)
+                 for early_reset in [False, True])
+
 
 if __name__ == '__main__':
+    from argparse import ArgumentParser
+
     parser = ArgumentParser(description='Build the microcode ROM contents for the 8bit breadboard computer.')
-    parser.add_argument('output_file', type=str, help='File to write the microcode binary to')
+    parser.add_argument('output_file', type=str, nargs='?', help='File to write the microcode binary to')
     parser.add_argument('-v', '--verbose', action='store_true', help='Display the produced microcode binary')
+    parser.add_argument('-a', '--analyze', action='store_true',
+                        help='Check the microcode for bus conflicts and for empty steps at the end of instructions, which can be skipped by resetting the microinstruction counter early.')
+    parser.add_argument('-m', '--microcode', type=str, metavar='bin_file', default=None,
+                        help='Analyze this EEPROM content (as a binary memory dump) instead of Ben Eaters original microcode.')
+    parser.add_argument('-p', '--programs', type=str, metavar='program_file', nargs='+', default=[],
+                        help='When analyzing, report how many clock cycles these programs save when the microinstruction counter is reset early.')
+    parser.add_argument('-c', '--max-cycles', type=int, default=10_000,
+                        help='Stop each program after this number of clock cycles. Defaults to 10 000.')
     args = parser.parse_args()
+    if args.output_file is None and not args.analyze:
+        parser.error('Specify an output file and/or --analyze.')
+    if (args.microcode or args.programs) and not args.analyze:
+        parser.error('--microcode and --programs can only be used together with --analyze.')
+
+    if args.output_file:
+        EEPROM = build_EEPROM(build_ucode())
+        with open(args.output_file, 'wb') as f:
+            for contents in EEPROM:
+                f.write(struct.pack('<B', contents))
+            if args.verbose:
+                for addr, contents in enumerate(EEPROM):
+                    if addr % 8 == 0:
+                        print(f'\n{addr:03x}:', end='')
+                    print(f' {contents:02x}', end='')
+                print(end='\n')
+
+    if args.analyze:
+        if args.microcode:
+            from memory_backend import map_EEPROM
+            analyzed_EEPROM = map_EEPROM(args.microcode)
+            analyzed_ucode = table_from_EEPROM(analyzed_EEPROM)
+        else:
+            analyzed_EEPROM = None
+            analyzed_ucode = build_ucode()
+
+        def describe(flags_list, instruction):
+            """Describe an instruction for some combinations of the flags."""
+            name = opcode_name(instruction).upper()
+            if len(flags_list) == 4:
+                return f'{name} (all flags)'
+            return f'{name} (flags {", ".join(f"Z{f >> 1}C{f & 1}" for f in flags_list)})'
+
+        # Report problems only once when they occur for multiple combinations
+        # of the flags.
+        conflicts = dict()
+        for flags, instruction, step, writers in find_bus_conflicts(analyzed_ucode):
+            conflicts.setdefault((instruction, step, '|'.join(writers)), list()).append(flags)
+        if conflicts:
+            print('Bus conflicts:')
+            for (instruction, step, writers), flags_list in conflicts.items():
+                print(f'  {describe(flags_list, instruction)} step {step}: {writers}')
+        else:
+            print('No bus conflicts.')
+
+        lengths = dict()
+        for flags, instruction, length in find_trailing_empty_steps(analyzed_ucode):
+            lengths.setdefault((instruction, length), list()).append(flags)
+        if lengths:
+            print(f'Instructions that can reset the microinstruction counter before step {NUM_STEPS}:')
+            for (instruction, length), flags_list in sorted(lengths.items()):
+                print(f'  {describe(flags_list, instruction)}: after step {length - 1}, '
+                      f'{length} steps instead of {NUM_STEPS}')
+        else:
+            print('All instructions use all steps.')
 
-    with open(args.output_file, 'wb') as f:
-        for contents in EEPROM:
-            f.write(struct.pack('<B', contents))
-        if args.verbose:
-            for addr, contents in enumerate(EEPROM):
-                if addr % 8 == 0:
-                    print(f'\n{addr:03x}:', end='')
-                print(f' {contents:02x}', end='')
-            print(end='\n')
+        if args.programs:
+            print('Clock cycles with and without early reset:')
+        for program_file in args.programs:
+            normal, early = compare_early_reset(program_file, analyzed_EEPROM, args.max_cycles)
+            if not (normal.halted and early.halted):
+                print(f'  {program_file}: did not halt within {args.max_cycles} cycles')
+            elif normal.outputs != early.outputs:
+                print(f'  {program_file}: the output differs with early reset!')
+            else:
+                saved = normal.cycles - early.cycles
+                print(f'  {program_file}: {normal.cycles} -> {early.cycles} '
+                      f'(saves {saved} cycles, {100 * saved / max(normal.cycles, 1):.1f}%)')
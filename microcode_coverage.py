@@ -0,0 +1,303 @@
+"""
+Measure which parts of the microcode of the SAP-1 8-bit breadboard computer
+are exercised by a set of programs.
+
+For each entry of the EEPROM, the number of steps (half clock-cycles) during
+which it drove the control lines is counted. The result is a coverage map over
+all 1024 EEPROM addresses, along with the microcode slots that were never used
+and the control signals that were never asserted. Coverage maps of different
+runs can be merged, so a whole corpus of programs can be checked against a new
+version of the microcode.
+
+Usage: python microcode_coverage.py [options] program_file [program_file ...]
+"""
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+import json
+import sys
+
+import microcode
+from memory_backend import map_EEPROM
+from observer import Observer
+from vcd import CONTROL_LINES
+
+# The two EEPROMs hold the high and low byte of each control word. They differ
+# only in the 7'th address line, so each slot of the microcode is identified by
+# a ROM address with that bit cleared.
+SLOTS = [address for address in range(1024) if not address & (1 << 7)]
+
+
+def _slot(flags, opcode, step):
+    """Get the ROM address of a microcode slot."""
+    return (flags << 8) + (opcode << 3) + step
+
+
+def _flags_name(flags):
+    """Get the name of a combination of flags, as used in microcode.py."""
+    return f'Z{flags >> 1}C{flags & 1}'
+
+
+def _signals_name(control_word):
+    """Get a human readable version of a control word, such as ``RO|II|CE``."""
+    return '|'.join(name for name in CONTROL_LINES if control_word & getattr(microcode, name)) or '0'
+
+
+class MicrocodeCoverage(Observer):
+    """Counts how often each microcode slot drives the control lines.
+
+    Attach it as an observer to the simulator (see observer.py). Each step, the
+    slot at the current ROM address is counted, which is the one that was read
+    by ``State.update_control_signals()``.
+
+    Parameters
+    ----------
+    EEPROM : list of int | bytes | None
+        The binary contents of the EEPROMs that are used as microcode. By
+        default (``None``) Ben Eater's original microcode is used.
+    """
+    def __init__(self, EEPROM=None):
+        if EEPROM is None:
+            EEPROM = microcode.EEPROM
+        self.EEPROM = bytes(EEPROM)
+        self.table = microcode.decode(self.EEPROM)
+        # Indexed by ROM address. Only the addresses in SLOTS are used.
+        self.counts = [0] * 1024
+
+    @property
+    def EEPROM_hash(self):
+        """A hash of the EEPROM contents, to make sure only coverage maps of
+        the same microcode are merged."""
+        return microcode.eeprom_hash(self.EEPROM).hex()
+
+    def sample(self, state):
+        """Count the slot at the current ROM address of the machine. Call this
+        once before the simulation starts, to count the very first step.
+
+        Parameters
+        ----------
+        state : State
+            The state of the machine as defined in simulator.py.
+        """
+        self.counts[state.rom_address] += 1
+
+    def on_half_step(self, state):
+        self.counts[state.rom_address] += 1
+
+    def merge(self, other):
+        """Add the counts of another coverage map to this one.
+
+        Parameters
+        ----------
+        other : MicrocodeCoverage
+            The coverage map to merge. It must have been measured with the same
+            microcode.
+        """
+        if other.EEPROM != self.EEPROM:
+            raise ValueError('Cannot merge the coverage of different versions of the microcode.')
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+
+    def used_slots(self):
+        """Get the ROM addresses of the slots that were used at least once."""
+        return [address for address in SLOTS if self.counts[address] > 0]
+
+    def unused_slots(self):
+        """Get the ROM addresses of the slots that were never used."""
+        return [address for address in SLOTS if self.counts[address] == 0]
+
+    def untested_slots(self):
+        """Get the ROM addresses of the slots that assert control signals, but
+        were never used. These are the parts of the microcode that the
+        programs did not test."""
+        return [address for address in self.unused_slots() if self.table[address].control_word]
+
+    def signal_counts(self):
+        """Count the number of steps during which each control signal was
+        asserted.
+
+        Returns
+        -------
+        counts : dict of str -> int
+            For each control signal, the number of steps.
+        """
+        counts = dict.fromkeys(CONTROL_LINES, 0)
+        for address, count in enumerate(self.counts):
+            control_word = self.table[address].control_word
+            if count and control_word:
+                for name in CONTROL_LINES:
+                    if control_word & getattr(microcode, name):
+                        counts[name] += count
+        return counts
+
+    def to_dict(self):
+        """Produce the coverage map as a dictionary that can be converted to
+        JSON. The map lists the number of reads of all 1024 EEPROM
+        addresses."""
+        return dict(
+            microcode=self.EEPROM_hash,
+            eeprom=[self.counts[address & ~(1 << 7)] for address in range(1024)],
+            signals=self.signal_counts(),
+            unused=[_describe_slot(address) for address in self.unused_slots()],
+            untested=[_describe_slot(address) for address in self.untested_slots()],
+        )
+
+    def to_json(self):
+        """Produce the coverage map in JSON format."""
+        return json.dumps(self.to_dict(), indent=2)
+
+    @classmethod
+    def from_dict(cls, d, EEPROM=None):
+        """Load a coverage map that was produced by ``to_dict()``.
+
+        Parameters
+        ----------
+        d : dict
+            The coverage map.
+        EEPROM : list of int | bytes | None
+            The microcode the map was measured with. By default (``None``) Ben
+            Eater's original microcode is used.
+
+        Returns
+        -------
+        coverage : MicrocodeCoverage
+            The coverage map.
+        """
+        coverage = cls(EEPROM)
+        if d['microcode'] != coverage.EEPROM_hash:
+            raise ValueError('The coverage map was measured with a different version of the microcode.')
+        if len(d['eeprom']) != 1024:
+            raise ValueError('The coverage map should list all 1024 EEPROM addresses.')
+        coverage.counts = [0 if address & (1 << 7) else count for address, count in enumerate(d['eeprom'])]
+        return coverage
+
+    def report(self):
+        """Produce a human readable report of the coverage.
+
+        The map shows a row for each opcode and a column for each step, for
+        each combination of the flags. Slots that were used are marked with
+        ``#`` (or ``+`` when they don't assert any control signals), unused
+        slots with ``-`` (or ``.`` when they don't assert any control signals).
+
+        Returns
+        -------
+        report : str
+            The report.
+        """
+        used_nonempty = [address for address in self.used_slots() if self.table[address].control_word]
+        nonempty = [address for address in SLOTS if self.table[address].control_word]
+        lines = [f'Used {len(self.used_slots())} of {len(SLOTS)} microcode slots, '
+                 f'{len(used_nonempty)} of {len(nonempty)} that assert control signals '
+                 f'({100 * len(used_nonempty) / max(len(nonempty), 1):.1f}%).', '']
+
+        lines.append('Coverage map (# used, - not used, + used but empty, . not used and empty):')
+        lines.append('        ' + ' '.join(f'{_flags_name(flags):8s}' for flags in range(4)))
+        for opcode in range(16):
+            row = list()
+            for flags in range(4):
+                cells = ''
+                for step in range(8):
+                    address = _slot(flags, opcode, step)
+                    if self.table[address].control_word:
+                        cells += '#' if self.counts[address] else '-'
+                    else:
+                        cells += '+' if self.counts[address] else '.'
+                row.append(cells)
+            lines.append(f'  {microcode.opcode_name(opcode):4s}  ' + ' '.join(row))
+        lines.append('')
+
+        untested = self.untested_slots()
+        if untested:
+            lines.append('Unused slots that assert control signals:')
+            for address in untested:
+                lines.append(f'  {_describe_slot(address)}: '
+                             f'{_signals_name(self.table[address].control_word)}')
+        else:
+            lines.append('All slots that assert control signals were used.')
+        lines.append('')
+
+        signal_counts = self.signal_counts()
+        never = [name for name, count in signal_counts.items() if count == 0]
+        lines.append('Steps during which each control signal was asserted:')
+        for name, count in signal_counts.items():
+            lines.append(f'  {count:10d}  {name}')
+        if never:
+            lines.append(f'Never asserted: {", ".join(never)}')
+        return '\n'.join(lines)
+
+
+def _describe_slot(address):
+    """Get a human readable description of a microcode slot."""
+    flags = address >> 8
+    opcode = (address >> 3) & 0x0f
+    step = address & 0b111
+    return f'{microcode.opcode_name(opcode)} flags {_flags_name(flags)} step {step}'
+
+
+def main(argv=None):
+    """Measure the microcode coverage from the command line.
+
+    Parameters
+    ----------
+    argv : list of str | None
+        The command line arguments. By default (``None``), these are taken from
+        ``sys.argv``.
+    """
+    parser = ArgumentParser(description=__doc__.split('\n\n')[1].replace('\n', ' '))
+    parser.add_argument('program_files', type=str, nargs='*', help='Programs to execute, written in assembly language.')
+    parser.add_argument('-m', '--microcode', type=str, metavar='bin_file', default=None,
+                        help='EEPROM contents to use as microcode (as a binary memory dump). Defaults to Ben Eaters original microcode.')
+    parser.add_argument('-b', '--bin', action='store_true',
+                        help='Specify that the program files are in binary rather than assembly language.')
+    parser.add_argument('-c', '--max-cycles', type=int, default=None,
+                        help='Stop each program after this number of clock cycles, even when it has not halted yet.')
+    parser.add_argument('-t', '--timeout', type=float, metavar='seconds', default=None,
+                        help='Stop each program after this number of seconds.')
+    parser.add_argument('-l', '--detect-loops', action='store_true',
+                        help='Stop programs that are stuck in an infinite loop.')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='Number of worker processes to use. Defaults to the number of CPUs.')
+    parser.add_argument('--merge', type=str, metavar='json_file', nargs='+', default=[],
+                        help='Add the coverage maps in these files, as written by --output, to the coverage of the programs.')
+    parser.add_argument('-o', '--output', type=str, metavar='json_file', default=None,
+                        help='Write the coverage map to this file in JSON format.')
+    args = parser.parse_args(argv)
+    if not args.program_files and not args.merge:
+        parser.error('Specify at least one program file or coverage map to merge.')
+
+    if args.microcode:
+        try:
+            EEPROM = map_EEPROM(args.microcode)
+        except (OSError, ValueError) as e:
+            parser.error(f'Could not load the microcode: {e}')
+    else:
+        EEPROM = None
+    coverage = MicrocodeCoverage(EEPROM)
+
+    for filename in args.merge:
+        try:
+            with open(filename) as f:
+                coverage.merge(MicrocodeCoverage.from_dict(json.load(f), EEPROM))
+        except (OSError, ValueError, KeyError) as e:
+            parser.error(f'Could not merge {filename}: {e}')
+
+    from batch import run_job
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = [executor.submit(run_job, program_file, args.microcode, args.bin, 'subcycle',
+                                   args.max_cycles, args.timeout, args.detect_loops, coverage=True)
+                   for program_file in args.program_files]
+        for future in futures:
+            result = future.result()
+            if 'error' in result:
+                print(f'{result["program"]}: {result["error"]}', file=sys.stderr)
+                continue
+            if not result['halted']:
+                print(f'{result["program"]}: stopped without halting ({result["reason"]}).', file=sys.stderr)
+            coverage.merge(MicrocodeCoverage.from_dict(result['coverage'], EEPROM))
+
+    print(coverage.report())
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(coverage.to_json())
+
+
+if __name__ == '__main__':
+    main()
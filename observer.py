@@ -0,0 +1,105 @@
+"""
+Observers of the SAP-1 8-bit breadboard computer simulator.
+
+An observer is notified of events during the simulation, such as the start of
+an instruction or a write to the RAM. Tools like tracers, breakpoints and
+coverage counters can be built on top of this, without having to change the
+simulator itself. Observers are attached with ``State.add_observer()`` or
+``Simulator.add_observer()``. As long as no observers are attached, the
+simulator runs at full speed.
+"""
+
+
+class Observer:
+    """Base class for observers of the simulator.
+
+    Override the methods for the events you are interested in. By default, all
+    of them do nothing. The events of a single step are reported in the order
+    of the methods below.
+    """
+    def on_ram_write(self, state, address, old, new):
+        """Called when a value was written to the RAM.
+
+        Parameters
+        ----------
+        state : State
+            The state of the machine as defined in simulator.py.
+        address : int
+            The RAM address that was written to.
+        old : int
+            The previous contents of the RAM at the address.
+        new : int
+            The new contents of the RAM at the address.
+        """
+        pass
+
+    def on_output(self, state, value):
+        """Called when a value was written to the output module.
+
+        Parameters
+        ----------
+        state : State
+            The state of the machine as defined in simulator.py.
+        value : int
+            The value that was written.
+        """
+        pass
+
+    def on_half_step(self, state):
+        """Called after each step (half a clock-cycle).
+
+        Parameters
+        ----------
+        state : State
+            The state of the machine as defined in simulator.py.
+        """
+        pass
+
+    def on_instruction_fetch(self, state, address):
+        """Called when the machine reaches the start of the next instruction,
+        right before it is fetched from the RAM.
+
+        Parameters
+        ----------
+        state : State
+            The state of the machine as defined in simulator.py.
+        address : int
+            The RAM address of the instruction.
+        """
+        pass
+
+    def on_halt(self, state):
+        """Called when the machine halts.
+
+        Parameters
+        ----------
+        state : State
+            The state of the machine as defined in simulator.py.
+        """
+        pass
+
+
+# The names of the methods of an observer that are called during the
+# simulation.
+HOOKS = ('on_ram_write', 'on_output', 'on_half_step', 'on_instruction_fetch', 'on_halt')
+
+
+def collect_hooks(observers):
+    """Collect the methods that the observers implement for each hook.
+
+    Methods that are not overridden from Observer do nothing, so there is no
+    need to call them.
+
+    Parameters
+    ----------
+    observers : list of Observer
+        The observers.
+
+    Returns
+    -------
+    hooks : dict of str -> list of callable
+        For each hook, the bound methods to call.
+    """
+    return {name: [getattr(observer, name) for observer in observers
+                   if getattr(type(observer), name) is not getattr(Observer, name)]
+            for name in HOOKS}
@@ -0,0 +1,186 @@
+"""
+Profiler for programs running on the SAP-1 8-bit breadboard computer simulator.
+
+Counts the clock cycles spent on each memory address, each opcode and each
+label, and finds the loops in which the most time is spent. Since the
+simulator is cycle-accurate, so is the profile.
+"""
+from collections import Counter
+
+from memory_backend import DEFAULT_ADDRESS_BITS
+from microcode import opcode_name
+
+
+class Profiler:
+    """Collects the number of clock cycles spent on each instruction.
+
+    Pass an instance to ``Simulator.run()`` or ``Simulator.iter_outputs()``.
+
+    Parameters
+    ----------
+    labels : dict of str -> int | None
+        The labels defined in the program, along with the memory address they
+        refer to, as produced by ``assemble(..., return_labels=True)``. Each
+        memory address is attributed to the label closest before it.
+    memory_human_readable : list of str | None
+        For each memory address, a human readable version of the contents,
+        which is shown in the report.
+    address_bits : int
+        The width of the program counter of the machine. Defaults to 4, like
+        the original computer.
+    """
+    def __init__(self, labels=None, memory_human_readable=None, address_bits=DEFAULT_ADDRESS_BITS):
+        self.labels = dict() if labels is None else dict(labels)
+        self.address_mask = (1 << address_bits) - 1
+        self.memory_human_readable = memory_human_readable
+        self.cycles_per_address = Counter()
+        self.instructions_per_address = Counter()
+        self.cycles_per_opcode = Counter()
+
+        # Number of times each backward jump was taken, indexed by (target
+        # address, source address).
+        self.backward_jumps = Counter()
+
+    def record(self, address, opcode, cycles, next_address):
+        """Record the execution of a single instruction.
+
+        Parameters
+        ----------
+        address : int
+            The memory address of the instruction.
+        opcode : int
+            The opcode of the instruction.
+        cycles : int
+            The number of clock cycles it took.
+        next_address : int
+            The memory address of the next instruction to be executed.
+        """
+        self.cycles_per_address[address] += cycles
+        self.instructions_per_address[address] += 1
+        self.cycles_per_opcode[opcode] += cycles
+        if next_address <= address and next_address != (address + 1) & self.address_mask:
+            self.backward_jumps[next_address, address] += 1
+
+    @property
+    def total_cycles(self):
+        """The total number of clock cycles recorded."""
+        return sum(self.cycles_per_address.values())
+
+    @property
+    def total_instructions(self):
+        """The total number of instructions recorded."""
+        return sum(self.instructions_per_address.values())
+
+    def label_of(self, address):
+        """Get the label closest before the given memory address (or ``None``
+        if there isn't one)."""
+        candidates = [(label_address, label) for label, label_address in self.labels.items()
+                      if label_address <= address]
+        if len(candidates) == 0:
+            return None
+        return max(candidates)[1]
+
+    def cycles_per_label(self):
+        """Count the number of clock cycles spent on the code following each
+        label.
+
+        Returns
+        -------
+        cycles : Counter
+            For each label, the number of clock cycles. Cycles spent before
+            the first label are counted under ``None``.
+        """
+        cycles = Counter()
+        for address, n in self.cycles_per_address.items():
+            cycles[self.label_of(address)] += n
+        return cycles
+
+    def loops(self):
+        """Find the loops, from hottest to coldest.
+
+        A loop is formed by a jump back to an earlier instruction and spans
+        all instructions from the target of the jump up to and including the
+        jump instruction.
+
+        Returns
+        -------
+        loops : list of dict
+            For each loop, the ``start`` and ``end`` address, the ``label`` at
+            the start, the number of times the jump back was taken
+            (``iterations``) and the number of ``cycles`` spent inside the
+            loop.
+        """
+        loops = list()
+        for (start, end), iterations in self.backward_jumps.items():
+            loops.append(dict(
+                start=start,
+                end=end,
+                label=self.label_of(start),
+                iterations=iterations,
+                cycles=sum(self.cycles_per_address[address] for address in range(start, end + 1)),
+            ))
+        return sorted(loops, key=lambda loop: loop['cycles'], reverse=True)
+
+    def to_dict(self):
+        """Produce the profile as a dictionary that can be converted to JSON."""
+        return dict(
+            total_cycles=self.total_cycles,
+            total_instructions=self.total_instructions,
+            addresses=[dict(address=address,
+                            cycles=self.cycles_per_address[address],
+                            instructions=self.instructions_per_address[address])
+                       for address in sorted(self.cycles_per_address)],
+            opcodes={opcode_name(opcode): cycles for opcode, cycles in self.cycles_per_opcode.most_common()},
+            labels={str(label): cycles for label, cycles in self.cycles_per_label().most_common()},
+            loops=self.loops(),
+        )
+
+    def to_json(self):
+        """Produce the profile in JSON format."""
+        import json
+        return json.dumps(self.to_dict(), indent=2)
+
+    def report(self, max_loops=5):
+        """Produce a human readable report of the profile.
+
+        Parameters
+        ----------
+        max_loops : int
+            The maximum number of loops to list. Defaults to 5.
+
+        Returns
+        -------
+        report : str
+            The report.
+        """
+        total = max(self.total_cycles, 1)
+        lines = [f'Total: {self.total_cycles} cycles, {self.total_instructions} instructions', '']
+
+        lines.append('Hottest loops:')
+        for loop in self.loops()[:max_loops]:
+            label = '' if loop['label'] is None else f' ({loop["label"]})'
+            lines.append(f'  {loop["start"]:02d}-{loop["end"]:02d}{label}: {loop["cycles"]} cycles '
+                         f'({100 * loop["cycles"] / total:.1f}%), {loop["iterations"]} iterations')
+        lines.append('')
+
+        lines.append('Cycles per address:')
+        for address in sorted(self.cycles_per_address):
+            cycles = self.cycles_per_address[address]
+            if self.memory_human_readable is not None and address < len(self.memory_human_readable):
+                line = self.memory_human_readable[address].rstrip()
+            else:
+                line = f'{address:02d}:'
+            lines.append(f'  {cycles:8d} {100 * cycles / total:5.1f}%  {line}')
+        lines.append('')
+
+        lines.append('Cycles per opcode:')
+        for opcode, cycles in self.cycles_per_opcode.most_common():
+            lines.append(f'  {cycles:8d} {100 * cycles / total:5.1f}%  {opcode_name(opcode)}')
+
+        if self.labels:
+            lines.append('')
+            lines.append('Cycles per label:')
+            for label, cycles in self.cycles_per_label().most_common():
+                lines.append(f'  {cycles:8d} {100 * cycles / total:5.1f}%  {label}')
+        return '\n'.join(lines)
+
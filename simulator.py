@@ -1,27 +1,110 @@
 """
 Simulator for the SAP-1 8-bit breadboard computer.
 """
-from argparse import ArgumentParser
-from time import time
-from collections import deque
-from dataclasses import dataclass, asdict, field
+from time import time, perf_counter, sleep
+import sys
+from dataclasses import dataclass, field, fields, replace
+from operator import attrgetter
 
 import microcode
-from assembler import assemble
+import snapshot
+from history import History, Timeline, DEFAULT_MAX_BYTES, position
+from observer import collect_hooks
+from breakpoints import Breakpoints
+from memory_backend import create_ram, DEFAULT_ADDRESS_BITS
 
 
-# To enable steping the clock backwards, we keep track of previous state
-# whenever we advance the clock.
-_previous_states = deque(maxlen=10_000)
+# The registers that are tracked by the undo history. To enable stepping the
+# clock backwards, we keep track of the changes made to these whenever we
+# advance the clock.
+_REGISTERS = (
+    'bus', 'rom_address', 'reg_a', 'reg_b', 'reg_instruction',
+    'reg_memory_address', 'reg_program_counter', 'reg_output', 'reg_flags',
+    'control_signals', 'flag_carry', 'flag_zero', 'clock', 'alu',
+    'microinstruction_counter',
+)
+_get_registers = attrgetter(*_REGISTERS)
+
+# Everything that is set back to its initial value when the machine is reset,
+# besides the RAM.
+_RESET = _REGISTERS + ('cycles', 'output_signed_mode')
+
+# The registers that, together with the RAM, determine what the machine will do
+# next. The step of the current instruction is included, so that a machine
+# halfway an instruction (for example after loading a saved state) is not
+# mistaken for one at the start of an instruction. The instruction engine has
+# no clock, since it only stops in between instructions.
+_ARCHITECTURAL_REGISTERS = (
+    'bus', 'reg_a', 'reg_b', 'reg_instruction', 'reg_memory_address',
+    'reg_program_counter', 'reg_output', 'reg_flags', 'microinstruction_counter',
+)
+_get_architectural_registers = attrgetter(*_ARCHITECTURAL_REGISTERS)
+_get_subcycle_registers = attrgetter(*_ARCHITECTURAL_REGISTERS, 'clock')
+
+
+# When running the clock in real time, the maximum number of steps to take in
+# one go and the maximum amount of time (in seconds) to lag behind.
+MAX_BATCH_SIZE = 1000
+MAX_LAG = 0.1
 
 
 @dataclass
+class RunResult:
+    """The result of running a program in batch mode."""
+    # The result of any OUT instructions encountered along the way
+    outputs: list[int]
+
+    # Why the run ended: 'halted', 'budget' (the maximum number of clock
+    # cycles was reached), 'timeout', 'loop' (an infinite loop was detected) or
+    # 'break' (a breakpoint was hit)
+    reason: str
+
+    # The number of clock cycles that were run
+    cycles: int
+
+    # The value of the program counter at the end of the run. When an infinite
+    # loop was detected, the address of an instruction inside the loop.
+    pc: int
+
+    # When a breakpoint was hit, a description of it
+    breakpoint: str = None
+
+    @property
+    def halted(self):
+        return self.reason == 'halted'
+
+    def __str__(self):
+        if self.reason == 'halted':
+            return f'Halted after {self.cycles} cycles.'
+        elif self.reason == 'budget':
+            return f'Stopped after reaching the maximum of {self.cycles} cycles (PC {self.pc}).'
+        elif self.reason == 'timeout':
+            return f'Timed out after {self.cycles} cycles (PC {self.pc}).'
+        elif self.reason == 'break':
+            return f'{self.breakpoint} Stopped after {self.cycles} cycles.'
+        else:
+            return f'Infinite loop detected at PC {self.pc} after {self.cycles} cycles.'
+
+
+@dataclass(slots=True)
 class State:
     """Object representing the state of the machine."""
     bus: int = 0
-    memory: list[int] = field(default_factory=lambda: [0] * 16)
-    memory_human_readable: list[str]  = field(default_factory=lambda: [''] * 16)
-    EEPROM : list[int] = field(default_factory=lambda: microcode.EEPROM)
+    memory: bytearray = field(default_factory=lambda: bytearray(16))
+
+    # For each memory address, a human readable version of the program that
+    # was loaded into the RAM, such as the line of assembler code (see
+    # memory_human_readable).
+    program_human_readable: tuple[str] = ()
+    EEPROM : bytes = field(default_factory=lambda: microcode.EEPROM)
+
+    # Whether the microinstruction counter resets as soon as the remaining
+    # steps of an instruction are empty (see microcode.decode())
+    early_reset: bool = False
+
+    # Width of the memory address register and program counter (see
+    # memory_backend.py)
+    address_bits: int = DEFAULT_ADDRESS_BITS
     rom_address: int = 0
 
     # Content of the registers
@@ -47,6 +130,66 @@ class State:
     microinstruction_counter: int = 0
     output_signed_mode: bool = False
 
+    # Number of clock cycles (rising edges of the clock) so far
+    cycles: int = 0
+
+    # Undo history. Keeping track of it is only needed when running the
+    # interface, so this can be turned off for extra speed.
+    history: History = field(default_factory=History, repr=False)
+    keep_history: bool = True
+    _ram_write: tuple = field(default=None, init=False, repr=False)
+
+    # The contents of the RAM when the machine was created, to return to when
+    # it is reset.
+    _program: bytes = field(default=None, init=False, repr=False)
+    _address_mask: int = field(default=None, init=False, repr=False)
+
+    # Observers that are notified of events during the simulation (see
+    # observer.py)
+    _observers: list = field(default_factory=list, init=False, repr=False)
+    _hooks: dict = field(default=None, init=False, repr=False)
+
+    # The microcode, decoded into a table of microinstructions, and the entry
+    # of the table that corresponds to the current control signals.
+    _microcode: list = field(default=None, init=False, repr=False)
+    microinstruction: microcode.MicroInstruction = field(default=None, init=False, repr=False)
+
+    def __post_init__(self):
+        self._program = bytes(self.memory)
+        self._address_mask = (1 << self.address_bits) - 1
+        self._microcode = microcode.decode(self.EEPROM, self.early_reset)
+        self.microinstruction = self._microcode[self.rom_address]
+
+    @property
+    def memory_human_readable(self):
+        """For each memory address, a human readable version of the contents of
+        the RAM. As long as an address holds the program that was loaded into
+        it, this is the corresponding entry of ``program_human_readable``.
+        Otherwise, it is a binary representation of the contents. These
+        strings are only produced when asked for."""
+        program, program_human_readable = self._program, self.program_human_readable
+        return [program_human_readable[address]
+                if address < len(program_human_readable) and contents == program[address]
+                else f'{address:02d}: {contents >> 4:04b} {contents & 0x0f:04b}'
+                for address, contents in enumerate(self.memory)]
+
+    def reset(self):
+        """Bring the machine back to its initial state, with the program it
+        was created with in the RAM."""
+        # Copy into the existing RAM, which may be mapped to a file (see
+        # memory_backend.py).
+        self.memory[:] = self._program
+        for f in fields(self):
+            if f.name in _RESET:
+                setattr(self, f.name, f.default)
+        self.history.clear()
+        self.update()
+
+    @property
+    def halted(self):
+        """Whether the HLT signal is active."""
+        return bool(self.control_signals & microcode.HLT)
+
     def update(self):
         """Update the state based on the values of the control lines. This does
         not touch the various clocks, so this can be called as often as needed
@@ -55,45 +198,48 @@ class State:
         # Set control lines based on current microinstruction.
         self.update_control_signals()
 
+        self._update_components()
+
+        # Changes of instruction and flags registers affect the control lines
+        self.update_control_signals()
+
+    def _update_components(self):
+        """Write to and read from the bus and compute the ALU outputs based on
+        the current values of the control lines."""
+        microinstruction = self.microinstruction
+
         # Write to the bus
-        if self.control_signals & microcode.AO:
+        bus_source = microinstruction.bus_source
+        if bus_source == microcode.BUS_A:
             self.bus = self.reg_a
-        if self.control_signals & microcode.EO:
+        elif bus_source == microcode.BUS_ALU:
             self.bus = self.alu
-        if self.control_signals & microcode.IO:
+        elif bus_source == microcode.BUS_INSTRUCTION:
             self.bus = self.reg_instruction & 0x0f
-        if self.control_signals & microcode.CO:
+        elif bus_source == microcode.BUS_PC:
             self.bus = self.reg_program_counter
-        if self.control_signals & microcode.RO:
+        elif bus_source == microcode.BUS_RAM:
             self.bus = self.memory[self.reg_memory_address]
 
         # Read from the bus
         if self.clock:
-            if self.control_signals & microcode.AI:
-                self.reg_a = self.bus
-            if self.control_signals & microcode.BI:
-                self.reg_b = self.bus
-            if self.control_signals & microcode.II:
-                self.reg_instruction = self.bus
-            if self.control_signals & microcode.MI:
-                self.reg_memory_address = self.bus
-            if self.control_signals & microcode.J:
-                self.reg_program_counter = self.bus
-            if self.control_signals & microcode.RI:
+            for register in microinstruction.readers:
+                setattr(self, register, self.bus)
+            # These registers are narrower than the bus
+            self.reg_memory_address &= self._address_mask
+            self.reg_program_counter &= self._address_mask
+            if microinstruction.RI:
                 address = self.reg_memory_address
+                if self.keep_history:
+                    self._ram_write = (address, self.memory[address])
                 self.memory[address] = self.bus
-                human_readable = f'{address:02d}: {self.bus >> 4:04b} {self.bus & 0x0f:04b}'
-                self.memory_human_readable[address] = human_readable
-            if self.control_signals & microcode.OI:
-                if self.bus != self.reg_output:
-                    self.reg_output = self.bus
 
-        # Transfer ALU flag outputs to the flags register
-        if self.clock and (self.control_signals & microcode.FI):
-            self.reg_flags = self.flag_carry + (self.flag_zero << 1)
+            # Transfer ALU flag outputs to the flags register
+            if microinstruction.FI:
+                self.reg_flags = self.flag_carry + (self.flag_zero << 1)
 
         # Do ALU stuff, set flag outputs
-        if self.control_signals & microcode.SU:
+        if microinstruction.SU:
             # Perform subtraction by computing the 8bit twos-complement
             # representation of register B.
             self.alu = self.reg_a + (self.reg_b ^ 0xff & 0xff) + 1
@@ -103,29 +249,49 @@ class State:
         self.alu &= 0xff
         self.flag_zero = self.alu == 0
 
-        # Changes of instruction and flags registers affect the control lines
-        self.update_control_signals()
-
     def update_control_signals(self):
         """Update the control signals based on the microcode EEPROMs.
 
         The control word is formed by combining two EEPROMs with identical
         contents. The 7'th address line is tied high on the first EEPROM and
         tied low on the second. Together they form the LSB and MSB of the
-        16-bit control word.
+        16-bit control word. To save time, the control words have been decoded
+        ahead of time (see microcode.decode()).
         """
-        self.rom_address = (self.reg_instruction & 0xf0) >> 1
-        self.rom_address += self.microinstruction_counter
-        if self.reg_flags & 0b01:  # Carry flag
-            self.rom_address += 1 << 8
-        if self.reg_flags & 0b10:  # Zero flag
-            self.rom_address += 1 << 9
-
-        # Combine the two EEPROMs
-        self.control_signals = (
-            (self.EEPROM[self.rom_address] << 8) +
-            (self.EEPROM[self.rom_address | (1 << 7)] & 0xff)
+        # Flags (carry and zero) form the two most significant bits
+        self.rom_address = (
+            (self.reg_flags << 8) +
+            ((self.reg_instruction & 0xf0) >> 1) +
+            self.microinstruction_counter
         )
+        self.microinstruction = self._microcode[self.rom_address]
+        self.control_signals = self.microinstruction.control_word
+
+    def step_instruction(self, max_cycles=None):
+        """Step the clock until the start of the next instruction.
+
+        Parameters
+        ----------
+        max_cycles : int | None
+            Stop halfway the instruction when the total number of clock cycles
+            reaches this number. By default (``None``), there is no limit.
+
+        Returns
+        -------
+        outputs : tuple of (int, int)
+            The values written to the output module (usually none or one),
+            along with the clock cycle during which they were written.
+        """
+        outputs = tuple()
+        while not self.control_signals & microcode.HLT:
+            out = self.step()
+            if out is not None:
+                outputs += ((self.cycles, out),)
+            if not self.clock and self.microinstruction_counter == 0:
+                break
+            if self.cycles == max_cycles:
+                break
+        return outputs
 
     def step(self):
         """Perform a single step (half a clock-cycle)."""
@@ -133,40 +299,125 @@ class State:
         if self.control_signals & microcode.HLT:
             return
 
-        # Before we update the state, keep a copy of the current state so we
-        # could revert later if we want.
-        global _previous_states
-        _previous_states.append(asdict(self))
+        # Before we update the state, keep a copy of the current registers so
+        # we can record what changed and revert later if we want.
+        if self.keep_history:
+            before = _get_registers(self)
+            self._ram_write = None
 
         # Flip clock signal
         self.clock = not self.clock
 
-        # Increment program counters
-        if self.control_signals & microcode.CE and self.clock:
-            self.reg_program_counter = (self.reg_program_counter + 1) % 16
-        if not self.clock:
-            self.microinstruction_counter = (self.microinstruction_counter + 1) % 5
+        # Update the system state now that the clock has changed. This is the
+        # same as calling update(), but only updates the control signals when
+        # they can actually change.
+        if self.clock:
+            self.cycles += 1
+            microinstruction = self.microinstruction
+            if microinstruction.CE:
+                self.reg_program_counter = (self.reg_program_counter + 1) & self._address_mask
+            self._update_components()
+            # Changes of instruction and flags registers affect the control
+            # lines
+            if microinstruction.II or microinstruction.FI:
+                self.update_control_signals()
+        else:
+            self.microinstruction_counter = self.microinstruction.next_step
+            self.update_control_signals()
+            self._update_components()
 
-        # Update the system state now that the clock has changed
-        self.update()
+        if self.keep_history:
+            self.history.record(before, _get_registers(self), self._ram_write)
 
         # Return the value written to the output module (if any)
-        if self.clock and (self.control_signals & microcode.OI):
+        if self.clock and self.microinstruction.OI:
             return self.reg_output
         else:
             return None
 
-    def _load_serialized_state(self, prev_state):
-        for k, v in prev_state.items():
-            if k.startswith('_'):
-                continue
-            setattr(self, k, v)
+    def add_observer(self, observer):
+        """Attach an observer that is notified of events during the simulation.
+
+        Parameters
+        ----------
+        observer : Observer
+            The observer, see observer.py.
+        """
+        self._observers.append(observer)
+        self._hooks = collect_hooks(self._observers)
+        # Only take the slower path through _step_observed() when there are
+        # observers attached.
+        self.__class__ = _ObservedState
+
+    def remove_observer(self, observer):
+        """Detach an observer.
+
+        Parameters
+        ----------
+        observer : Observer
+            The observer, see observer.py.
+        """
+        self._observers.remove(observer)
+        self._hooks = collect_hooks(self._observers)
+        if len(self._observers) == 0:
+            self.__class__ = State
+
+    def _step_observed(self):
+        """Perform a single step (half a clock-cycle) and notify the
+        observers."""
+        if self.control_signals & microcode.HLT:
+            return
+        hooks = self._hooks
+        ram_write = hooks['on_ram_write'] and not self.clock and self.microinstruction.RI
+        if ram_write:
+            memory_before = bytes(self.memory)
+
+        out = State.step(self)
+
+        if ram_write:
+            address = self.reg_memory_address
+            for hook in hooks['on_ram_write']:
+                hook(self, address, memory_before[address], self.memory[address])
+        if out is not None:
+            for hook in hooks['on_output']:
+                hook(self, out)
+        for hook in hooks['on_half_step']:
+            hook(self)
+        if not self.clock and self.microinstruction_counter == 0:
+            for hook in hooks['on_instruction_fetch']:
+                hook(self, self.reg_program_counter)
+        if self.control_signals & microcode.HLT:
+            for hook in hooks['on_halt']:
+                hook(self)
+        return out
 
     def revert(self):
-        global _previous_states
-        if len(_previous_states) > 0:
-            prev_state = _previous_states.pop()
-            self._load_serialized_state(prev_state)
+        """Undo the last step (if there is any history left)."""
+        if len(self.history) == 0:
+            return
+        if self.clock:
+            self.cycles -= 1
+        changes, ram_write = self.history.pop()
+        for index, value in changes:
+            name = _REGISTERS[index]
+            # Restore the original type, as some registers are booleans.
+            setattr(self, name, type(getattr(self, name))(value))
+        self.microinstruction = self._microcode[self.rom_address]
+        if ram_write is not None:
+            address, contents = ram_write
+            self.memory[address] = contents
+
+    # Steps that are re-run from a checkpoint (see history.Timeline) bypass the
+    # observers, since they have seen these steps before.
+    replay_step = step
+
+
+class _ObservedState(State):
+    """The state of the machine while observers are attached. Switching to
+    this class (see ``State.add_observer()``) routes ``step()`` through
+    ``State._step_observed()``."""
+    __slots__ = ()
+    step = State._step_observed
 
 
 class Simulator:
@@ -175,10 +426,10 @@ class Simulator:
     Parameters
     ----------
     memory : list of int
-        For each memory address (there should be a maximum of 16), the contents
-        (an 8 bit number, so from 0-255) of the RAM at that address. Generally,
-        you want to use the assembler to generate the RAM contens based on
-        assembler code.
+        For each memory address (there should be a maximum of 16, or
+        ``2 ** address_bits``), the contents (an 8 bit number, so from 0-255)
+        of the RAM at that address. Generally, you want to use the assembler
+        to generate the RAM contens based on assembler code.
     memory_human_readable : list of str | None
         For each memory address, a human readable version of the contents of
         the RAM at that address. For example, it could be the line of assembler
@@ -191,64 +442,474 @@ class Simulator:
         first EEPROM and tied low on the second. Together they form the LSB and
         MSB of the 16-bit control word. By default (``None``) Ben Eater's
         original microcode is used.
+    history_size : int
+        The maximum number of bytes to use for keeping track of the history of
+        the system state, which allows stepping the clock backwards. Defaults
+        to 64 MiB.
+    engine : 'subcycle' | 'instruction'
+        Which simulator to use. The subcycle-accurate simulator (the default)
+        simulates both flanks of the clock. The instruction-level simulator
+        runs a whole instruction at a time, which is faster, but can only be
+        used in batch mode.
+    labels : dict of str -> int | None
+        The labels defined in the program, along with the memory address they
+        refer to, as produced by ``assemble(..., return_labels=True)``. These
+        can be used when setting breakpoints.
+    early_reset : bool
+        Whether to reset the microinstruction counter as soon as the remaining
+        steps of an instruction don't assert any control signals, so
+        instructions no longer take a fixed number of clock cycles. See
+        ``microcode.py --analyze``. Defaults to ``False``.
+    address_bits : int
+        The width of the memory address register and program counter, which
+        determines the size of the RAM. Defaults to 4 (16 bytes of RAM), like
+        the original computer. Expanded builds can use up to 8 bits.
+    ram_backend : 'list' | 'bytearray' | 'mmap'
+        How to store the RAM, see memory_backend.py. Defaults to
+        ``'bytearray'``.
+    ram_file : str | None
+        When using the ``'mmap'`` backend, the RAM image file. Other processes
+        can inspect the RAM through this file while the simulator runs. The
+        file is overwritten with the program whenever the machine is reset.
     """
-    def __init__(self, memory, memory_human_readable=None, EEPROM=None):
-        self._init_memory = memory
+    def __init__(self, memory, memory_human_readable=None, EEPROM=None,
+                 history_size=DEFAULT_MAX_BYTES, engine='subcycle', labels=None,
+                 early_reset=False, address_bits=DEFAULT_ADDRESS_BITS,
+                 ram_backend='bytearray', ram_file=None):
+        if engine not in ['subcycle', 'instruction']:
+            raise ValueError(f'Invalid engine: {engine}')
+        self.engine = engine
+        self.address_bits = address_bits
+        self._init_memory = bytes(memory)
         if memory_human_readable is None:
-            self._init_memory_human_readable = [
+            self._init_memory_human_readable = tuple(
                 f'{addr + 1:02d} {content >> 4:04b} {content & 0xf:04b}'
-                for addr, content in enumerate(memory)]
+                for addr, content in enumerate(memory))
         else:
-            self._init_memory_human_readable = memory_human_readable
+            self._init_memory_human_readable = tuple(memory_human_readable)
 
         if EEPROM is None:
             self.EEPROM = microcode.EEPROM
         else:
             self.EEPROM = EEPROM
+        self.history_size = history_size
+        self.early_reset = early_reset
 
         # Variables related to automatic stepping of the clock
         self.clock_automatic = False
         self.clock_speed = 1  # Hz
         self.last_clock_time = 0 # Keep track of when the next clock was last stepped
 
-        # Initialize system state
+        # The reason the last batch run stopped
+        self.result = None
+
+        # Checkpoints for going back further than the undo history reaches
+        self.timeline = Timeline()
+
+        # Observers that are notified of events during the simulation. These
+        # stay attached when the machine is reset.
+        self.observers = list()
+
+        # Breakpoints are only attached as an observer when there are any
+        self.breakpoints = Breakpoints(labels, address_bits)
+
+        # Initialize system state. The subcycle engine keeps the same state
+        # object, which is reset in place.
+        if engine == 'subcycle':
+            self.state = State(
+                memory=create_ram(self._init_memory, address_bits, ram_backend, ram_file),
+                program_human_readable=self._init_memory_human_readable,
+                EEPROM=self.EEPROM,
+                early_reset=early_reset,
+                address_bits=address_bits,
+                history=History(history_size),
+            )
         self.reset()
 
-    def run_batch(self):
+    def run_batch(self, max_cycles=None):
         """Run the simulator in batch mode until the HLT instruction is reached.
 
+        Parameters
+        ----------
+        max_cycles : int | None
+            Stop when the total number of clock cycles reaches this number,
+            even when the HLT instruction has not been reached yet. By default
+            (``None``), there is no limit.
+
         Returns
         -------
         outputs : list of int
             The result of any OUT instructions encountered along the way.
         """
-        self.state.keep_history = False  # Not needed, so turn off for extra speed
-        outputs = list()
-        while not self.state.control_signals & microcode.HLT:
-            out = self.state.step()
-            if out is not None:
-                outputs.append(out)
-        return outputs
+        return self.run(max_cycles).outputs
+
+    def run(self, max_cycles=None, timeout=None, detect_loops=False, profiler=None):
+        """Run the simulator in batch mode until the program ends.
+
+        Parameters
+        ----------
+        max_cycles : int | None
+            Stop when the total number of clock cycles reaches this number,
+            even when the HLT instruction has not been reached yet. By default
+            (``None``), there is no limit.
+        timeout : float | None
+            Stop after this many seconds. By default (``None``), there is no
+            limit.
+        detect_loops : bool
+            Whether to stop when the program is stuck in an infinite loop. This
+            is detected by comparing the state of the machine (registers and
+            RAM) at the start of each instruction to a previous state. When the
+            machine ends up in exactly the same state as before, it will keep
+            repeating itself forever. Defaults to ``False``.
+        profiler : Profiler | None
+            Record the number of clock cycles spent on each instruction in
+            this profiler (see profiler.py). By default (``None``), no profile
+            is made.
+
+        Returns
+        -------
+        result : RunResult
+            The outputs of the program and the reason it stopped.
+        """
+        outputs = [value for _, value in self.iter_outputs(max_cycles, timeout, detect_loops, profiler)]
+        return replace(self.result, outputs=outputs)
+
+    def iter_outputs(self, max_cycles=None, timeout=None, detect_loops=False, profiler=None):
+        """Run the simulator in batch mode, producing outputs as they happen.
+
+        This can be used to process the outputs of programs that run for a long
+        time (or forever) while they are running.
+
+        Parameters
+        ----------
+        max_cycles : int | None
+            Stop when the total number of clock cycles reaches this number,
+            even when the HLT instruction has not been reached yet. By default
+            (``None``), there is no limit.
+        timeout : float | None
+            Stop after this many seconds. By default (``None``), there is no
+            limit.
+        detect_loops : bool
+            Whether to stop when the program is stuck in an infinite loop. See
+            ``run()``. Defaults to ``False``.
+        profiler : Profiler | None
+            Record the number of clock cycles spent on each instruction in
+            this profiler (see profiler.py). By default (``None``), no profile
+            is made.
+
+        Yields
+        ------
+        cycle : int
+            The clock cycle during which the output was written.
+        value : int
+            The value written to the output module.
+
+        Notes
+        -----
+        When the generator is exhausted, ``self.result`` holds a RunResult
+        with the reason the program stopped (but without the outputs).
+        """
+        if self.engine != 'subcycle':
+            yield from self._iter_outputs(max_cycles, timeout, detect_loops, profiler)
+            return
+
+        # The undo history is not needed, so turn it off for extra speed until
+        # the generator finishes or is closed.
+        state = self.state
+        keep_history = state.keep_history
+        state.keep_history = False
+        try:
+            yield from self._iter_outputs(max_cycles, timeout, detect_loops, profiler)
+        finally:
+            state.keep_history = keep_history
+
+    def _iter_outputs(self, max_cycles, timeout, detect_loops, profiler):
+        """Run the simulator in batch mode. See ``iter_outputs()``."""
+        if max_cycles is None:
+            max_cycles = float('inf')
+        self.result = None
+        self.breakpoints.hit = None
+
+        state = self.state
+        if self.engine == 'subcycle':
+            if timeout is None and not detect_loops and profiler is None and len(self.breakpoints) == 0:
+                # Fast path
+                while not state.control_signals & microcode.HLT and state.cycles < max_cycles:
+                    out = state.step()
+                    if out is not None:
+                        yield state.cycles, out
+                reason = 'halted' if state.halted else 'budget'
+                self.result = RunResult([], reason, state.cycles, state.reg_program_counter)
+                return
+            step_instruction = state.step_instruction
+            get_registers = _get_subcycle_registers
+        else:
+            step_instruction = state.step
+            get_registers = _get_architectural_registers
+
+        # Run one instruction at a time, checking the stopping criteria
+        # (including breakpoints) in between. To detect infinite loops, the
+        # state of the machine is compared to a saved state, which is
+        # periodically replaced with the current state at exponentially growing
+        # intervals (Brent's algorithm). When the machine is caught in a loop,
+        # eventually the saved state will be part of that loop and come around
+        # again.
+        deadline = float('inf') if timeout is None else perf_counter() + timeout
+        saved_state = None
+        power = period = 1
+        while True:
+            if self.breakpoints.hit is not None:
+                reason = 'break'
+                break
+            if state.halted:
+                reason = 'halted'
+                break
+            if state.cycles >= max_cycles:
+                reason = 'budget'
+                break
+            if perf_counter() > deadline:
+                reason = 'timeout'
+                break
+            if detect_loops:
+                current_state = (get_registers(state), tuple(state.memory))
+                if current_state == saved_state:
+                    reason = 'loop'
+                    break
+                if period == power:
+                    saved_state = current_state
+                    power *= 2
+                    period = 0
+                period += 1
+            if profiler is None:
+                yield from step_instruction(max_cycles)
+            else:
+                address, cycles = state.reg_program_counter, state.cycles
+                yield from step_instruction(max_cycles)
+                profiler.record(address, state.reg_instruction >> 4, state.cycles - cycles,
+                                state.reg_program_counter)
+        self.result = RunResult([], reason, state.cycles, state.reg_program_counter,
+                                self.breakpoints.hit)
+        self.breakpoints.hit = None
 
     def step(self):
         """Step the clock while keeping track of time."""
+        self._start_timeline()
         self.last_clock_time = time()
         self.state.step()
+        self.timeline.record(self.state)
+
+    def run_until(self, deadline):
+        """Keep stepping the clock at the pace set by ``clock_speed`` until the
+        given time.
+
+        Steps are taken in batches, rather than waiting for the right moment
+        to take each step, so that high clock speeds can be reached. When the
+        simulation cannot keep up with the clock speed, it runs as fast as it
+        can. Stops early when the machine halts or a breakpoint is hit.
+
+        Parameters
+        ----------
+        deadline : float
+            The time (as given by ``time.time()``) at which to stop.
+
+        Returns
+        -------
+        n_steps : int
+            The number of steps (half clock-cycles) that were taken.
+        """
+        self._start_timeline()
+        state = self.state
+        step_time = 0.5 / self.clock_speed
+        n_steps = 0
+        while not state.halted and self.breakpoints.hit is None:
+            now = time()
+            if now >= deadline:
+                break
+
+            # Don't try to make up for lost time after falling behind
+            self.last_clock_time = max(self.last_clock_time, now - MAX_LAG)
+
+            # Take the steps that are due, a limited number at a time so we
+            # don't overshoot the deadline by much.
+            n_due = min(int((now - self.last_clock_time) / step_time), MAX_BATCH_SIZE)
+            if n_due == 0:
+                sleep(min(deadline, self.last_clock_time + step_time) - now)
+                continue
+            for _ in range(n_due):
+                state.step()
+                self.timeline.record(state)
+                n_steps += 1
+                if state.halted or self.breakpoints.hit is not None:
+                    break
+            self.last_clock_time += n_due * step_time
+        return n_steps
+
+    def step_back(self, n=1):
+        """Step the clock backwards.
+
+        Recent steps are undone using the undo history. When that doesn't reach
+        far enough back, the simulation is re-run from a checkpoint instead.
+
+        Parameters
+        ----------
+        n : int
+            The number of steps (half clock-cycles) to go back. Defaults to 1.
+        """
+        self._start_timeline()
+        state = self.state
+        target = max(position(state) - n, 0)
+        while position(state) > target and len(state.history) > 0:
+            state.revert()
+        if position(state) > target:
+            self.timeline.goto(state, target)
+
+    def reverse_to_output(self):
+        """Go back to the last time a value was written to the output module.
+
+        Returns
+        -------
+        found : bool
+            Whether there was such a time. If not, the machine is left as it
+            was.
+        """
+        return self._reverse_to(lambda state, microinstruction, output: output is not None)
+
+    def reverse_to_write(self, address):
+        """Go back to the last time the given RAM address was written to.
+
+        Parameters
+        ----------
+        address : int
+            The RAM address.
+
+        Returns
+        -------
+        found : bool
+            Whether there was such a time. If not, the machine is left as it
+            was.
+        """
+        def condition(state, microinstruction, output):
+            # RAM is written when the clock goes high
+            return state.clock and microinstruction.RI and state.reg_memory_address == address
+        return self._reverse_to(condition)
+
+    def _reverse_to(self, condition):
+        """Go back to the last time the condition was met, see
+        ``Timeline.find_last()``."""
+        self._start_timeline()
+        pos = self.timeline.find_last(self.state, condition)
+        if pos is None:
+            return False
+        self.timeline.goto(self.state, pos)
+        return True
 
     def reset(self):
         """Reset the machine."""
-        global _previous_states
-        _previous_states.clear()
-        self.state = State(
-            memory=self._init_memory,
-            memory_human_readable=self._init_memory_human_readable,
-            EEPROM=self.EEPROM
-        )
-        self.state.update()
+        if self.engine == 'instruction':
+            from instruction_engine import InstructionState
+            self.state = InstructionState(self._init_memory, self.EEPROM, self.early_reset,
+                                          self.address_bits)
+            return
+        self.state.reset()
+        self.timeline.clear()
+
+    def _start_timeline(self):
+        """Make the first checkpoint of the timeline, if there is none yet.
+
+        This is postponed until the clock is stepped by hand or the machine
+        goes back in time, so batch runs don't pay for a checkpoint they will
+        never use.
+        """
+        if len(self.timeline) == 0:
+            self.timeline.record(self.state)
+
+    def add_observer(self, observer):
+        """Attach an observer that is notified of events during the simulation.
+
+        Parameters
+        ----------
+        observer : Observer
+            The observer, see observer.py.
+        """
+        if self.engine != 'subcycle':
+            raise ValueError('Observers are only supported by the subcycle engine.')
+        self.observers.append(observer)
+        self.state.add_observer(observer)
+
+    def remove_observer(self, observer):
+        """Detach an observer.
+
+        Parameters
+        ----------
+        observer : Observer
+            The observer, see observer.py.
+        """
+        self.observers.remove(observer)
+        self.state.remove_observer(observer)
+
+    def add_breakpoint(self, spec):
+        """Add a breakpoint or watchpoint.
+
+        Parameters
+        ----------
+        spec : str
+            The breakpoint, for example ``'loop'``, ``'A == 0 && flags.C'`` or
+            ``'write 14'``. See breakpoints.py for all possibilities.
+        """
+        self.breakpoints.add(spec)
+        if self.breakpoints not in self.observers:
+            self.add_observer(self.breakpoints)
+
+    def clear_breakpoints(self):
+        """Remove all breakpoints and watchpoints."""
+        self.breakpoints.clear()
+        if self.breakpoints in self.observers:
+            self.remove_observer(self.breakpoints)
+
+    def save_state(self, filename):
+        """Save the current state of the machine to a snapshot file.
+
+        Parameters
+        ----------
+        filename : str
+            The file to write the snapshot to.
+        """
+        if self.engine != 'subcycle':
+            raise ValueError('Saving the state is only supported by the subcycle engine.')
+        snapshot.save(self.state, filename)
+
+    def load_state(self, filename):
+        """Restore the state of the machine from a snapshot file.
+
+        The microcode, address width and early reset setting must be the same
+        as the ones used to create the snapshot.
+        Resetting the machine afterwards will start the program from the
+        beginning.
+
+        Parameters
+        ----------
+        filename : str
+            The snapshot file to read.
+        """
+        if self.engine != 'subcycle':
+            raise ValueError('Loading the state is only supported by the subcycle engine.')
+        snapshot.load(self.state, filename)
+        self.timeline.clear()
 
 
 if __name__ == '__main__':
-    parser = ArgumentParser(description=__doc__)
+    # These are only needed when running from the command line, so they are
+    # not imported when the simulator is used as a module.
+    from argparse import ArgumentParser
+    from assembler import assemble, AssemblerError
+    from memory_backend import map_EEPROM, BACKENDS, MAX_ADDRESS_BITS
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+        import batch
+        batch.main(sys.argv[2:])
+        sys.exit(0)
+
+    parser = ArgumentParser(description=__doc__, epilog='Use "simulator.py batch --help" to find out how to run many programs at once.')
     parser.add_argument('program_file', type=str, help='Program to execute, written in assembly language.')
     parser.add_argument('-n', '--no-interface', action='store_true',
                         help="Don't show the interface, but run the program in batch mode.")
@@ -256,25 +917,140 @@ if __name__ == '__main__':
                         help='EEPROM content to use as microcode (as a binary memory dump). Defaults to Ben Eaters original microcode.')
     parser.add_argument('-b', '--bin', action='store_true',
                         help='Specify that the program file is in binary rather than assembly language.')
+    parser.add_argument('--early-reset', action='store_true',
+                        help='Reset the microinstruction counter as soon as the remaining steps of an instruction are empty, so instructions take fewer clock cycles (see "microcode.py --analyze").')
+    parser.add_argument('-e', '--engine', choices=['subcycle', 'instruction'], default='subcycle',
+                        help='Simulate both flanks of the clock (subcycle, the default) or a whole instruction at a time (instruction). The latter is faster, but only works in batch mode.')
+    parser.add_argument('-c', '--max-cycles', type=int, default=None,
+                        help='When running in batch mode, stop after this number of clock cycles, even when the program has not halted yet.')
+    parser.add_argument('-t', '--timeout', type=float, metavar='seconds', default=None,
+                        help='When running in batch mode, stop after this number of seconds.')
+    parser.add_argument('-l', '--detect-loops', action='store_true',
+                        help='When running in batch mode, stop when the program is stuck in an infinite loop.')
+    parser.add_argument('--timestamps', action='store_true',
+                        help='When running in batch mode, print the clock cycle during which each value was sent to the output.')
+    parser.add_argument('-s', '--stats', action='store_true',
+                        help='When running in batch mode, report the number of clock cycles and the simulation speed.')
+    parser.add_argument('--profile', action='store_true',
+                        help='When running in batch mode, report the number of clock cycles spent on each instruction, opcode, label and loop.')
+    parser.add_argument('--profile-json', type=str, metavar='json_file', default=None,
+                        help='When running in batch mode, write the profile to this file in JSON format.')
+    parser.add_argument('--vcd', type=str, metavar='vcd_file', default=None,
+                        help='When running in batch mode, record the control lines, bus, clock and registers to this file in Value Change Dump format.')
+    parser.add_argument('--break', type=str, metavar='breakpoint', action='append', default=[], dest='breakpoints',
+                        help='Stop at a breakpoint, for example an address or label ("loop"), a condition ("A == 0 && flags.C"), both ("loop if A == 0") or a write to a RAM address or label ("write 14"). Can be given multiple times.')
+    parser.add_argument('--load-state', type=str, metavar='snapshot_file', default=None,
+                        help='Start from the state of the machine saved in this file, rather than from the beginning of the program.')
+    parser.add_argument('--save-state', type=str, metavar='snapshot_file', default=None,
+                        help='Save the state of the machine to this file when the program stops (in batch mode) or when pressing "s" (in the interface).')
+    parser.add_argument('--address-bits', type=int, metavar='bits', default=DEFAULT_ADDRESS_BITS,
+                        help=f'Width of the memory address register and program counter, for expanded builds with more RAM. Can be up to {MAX_ADDRESS_BITS} bits (256 bytes of RAM). Defaults to {DEFAULT_ADDRESS_BITS} bits (16 bytes of RAM).')
+    parser.add_argument('--ram', choices=BACKENDS, default=None, dest='ram_backend',
+                        help='How to store the RAM: as a list, a bytearray (the default) or a memory map (see memory_backend.py).')
+    parser.add_argument('--ram-file', type=str, metavar='image_file', default=None,
+                        help='Map the RAM to this file, so it can be inspected by other programs while the simulator is running. The file is overwritten with the program. Implies "--ram mmap".')
+    parser.add_argument('--history-size', type=float, metavar='MiB', default=DEFAULT_MAX_BYTES / 2**20,
+                        help='Amount of memory to use for the history that allows stepping the clock backwards. Defaults to 64 MiB.')
     args = parser.parse_args()
+    if args.engine != 'subcycle' and not args.no_interface:
+        parser.error('The instruction-level engine can only be used together with --no-interface.')
+    if (args.profile or args.profile_json) and not args.no_interface:
+        parser.error('Profiling can only be used together with --no-interface.')
+    if args.vcd and (args.engine != 'subcycle' or not args.no_interface):
+        parser.error('Recording to a VCD file can only be used with the subcycle engine together with --no-interface.')
+    if args.breakpoints and args.engine != 'subcycle':
+        parser.error('Breakpoints are only supported by the subcycle engine.')
+    if args.engine != 'subcycle' and (args.load_state or args.save_state):
+        parser.error('Loading and saving the state is only supported by the subcycle engine.')
+    if args.address_bits != DEFAULT_ADDRESS_BITS and not args.no_interface:
+        parser.error(f'The interface only shows {2 ** DEFAULT_ADDRESS_BITS} bytes of RAM. Use --no-interface together with --ram-file to inspect a larger RAM.')
+    if args.ram_file:
+        if args.ram_backend not in (None, 'mmap'):
+            parser.error('A RAM image file can only be used together with "--ram mmap".')
+        args.ram_backend = 'mmap'
+    if args.ram_file and args.engine != 'subcycle':
+        parser.error('A RAM image file is only supported by the subcycle engine.')
 
     if args.microcode:
-        with open(args.microcode, 'rb') as f:
-            EEPROM = f.read()
+        try:
+            EEPROM = map_EEPROM(args.microcode)
+        except (OSError, ValueError) as e:
+            parser.error(f'Could not load the microcode: {e}')
     else:
         EEPROM = None
 
     if args.bin:
         with open(args.program_file, 'rb') as f:
-            simulator = Simulator(memory=list(f.read()), EEPROM=EEPROM)
+            memory, memory_human_readable, labels = list(f.read()), None, None
     else:
         with open(args.program_file) as f:
-            simulator = Simulator(*assemble(f.read()), EEPROM=EEPROM)
+            try:
+                memory, memory_human_readable, labels = assemble(f.read(), return_labels=True)
+            except AssemblerError as e:
+                print(e, file=sys.stderr)
+                sys.exit(1)
+    try:
+        simulator = Simulator(memory, memory_human_readable, EEPROM=EEPROM,
+                              history_size=int(args.history_size * 2**20),
+                              engine=args.engine, labels=labels, early_reset=args.early_reset,
+                              address_bits=args.address_bits, ram_backend=args.ram_backend or 'bytearray',
+                              ram_file=args.ram_file)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+
+    for breakpoint in args.breakpoints:
+        try:
+            simulator.add_breakpoint(breakpoint)
+        except ValueError as e:
+            parser.error(str(e))
+
+    if args.load_state:
+        try:
+            simulator.load_state(args.load_state)
+        except (OSError, ValueError) as e:
+            parser.error(f'Could not load the state: {e}')
 
     if args.no_interface:
-        for out in simulator.run_batch():
-            print(out)
+        if args.profile or args.profile_json:
+            from profiler import Profiler
+            profiler = Profiler(labels, simulator._init_memory_human_readable, args.address_bits)
+        else:
+            profiler = None
+        if args.vcd:
+            vcd_file = open(args.vcd, 'w')
+            from vcd import VCDWriter
+            vcd = VCDWriter(vcd_file, address_bits=args.address_bits)
+            vcd.sample(simulator.state)
+            simulator.add_observer(vcd)
+        start_time = perf_counter()
+        try:
+            for cycle, out in simulator.iter_outputs(args.max_cycles, args.timeout, args.detect_loops, profiler):
+                if args.timestamps:
+                    print(cycle, out, flush=True)
+                else:
+                    print(out, flush=True)
+        except BrokenPipeError:
+            # The program reading our output has stopped (e.g. "| head")
+            sys.stdout = None
+            sys.exit(0)
+        elapsed = perf_counter() - start_time
+        result = simulator.result
+        if args.vcd:
+            vcd_file.close()
+        if args.save_state:
+            simulator.save_state(args.save_state)
+        if args.stats:
+            print(f'{result.cycles} cycles in {elapsed:.3f} s '
+                  f'({result.cycles / elapsed:.0f} cycles/s)', file=sys.stderr)
+        if args.profile:
+            print(profiler.report(), file=sys.stderr)
+        if args.profile_json:
+            with open(args.profile_json, 'w') as f:
+                f.write(profiler.to_json())
+        if not result.halted:
+            print(result, file=sys.stderr)
+            sys.exit(1)
     else:
         import curses
         import interface
-        curses.wrapper(interface.run_interface, simulator)
+        curses.wrapper(interface.run_interface, simulator, args.save_state)
@@ -0,0 +1,144 @@
+"""
+Save and restore the state of the simulated SAP-1 8-bit breadboard computer.
+
+The state is stored in a compact binary format: a small header with the
+registers, followed by the contents of the RAM. Instead of the contents of the
+microcode EEPROM, only a hash of it is stored. The EEPROM contents themselves
+are checked against this hash when restoring the state, as are the width of the
+memory address register and whether the microinstruction counter resets early,
+since both change how the machine behaves from then on.
+"""
+import struct
+
+import microcode
+
+# Marks the start of a snapshot
+MAGIC = b'8bit'
+
+# Version of the format, increase this when the format changes.
+VERSION = 2
+
+# Layout of the header. In order: magic, version, hash of the EEPROM, width of
+# the memory address register, early reset of the microinstruction counter,
+# number of clock cycles, bus, "A" register, "B" register, instruction
+# register, memory address register, program counter, output register, flags
+# register, ALU, microinstruction counter, clock/carry/zero bits, size of the
+# RAM.
+_HEADER = struct.Struct('<4sB16sB?Q11BH')
+
+# Bits used to store the clock and ALU flag outputs
+_CLOCK, _CARRY, _ZERO = 0b001, 0b010, 0b100
+
+
+def dumps(state):
+    """Save the state of the machine to a snapshot.
+
+    Parameters
+    ----------
+    state : State
+        The state of the machine as defined in simulator.py.
+
+    Returns
+    -------
+    snapshot : bytes
+        The snapshot.
+    """
+    bits = ((_CLOCK if state.clock else 0) |
+            (_CARRY if state.flag_carry else 0) |
+            (_ZERO if state.flag_zero else 0))
+    header = _HEADER.pack(
+        MAGIC, VERSION, microcode.eeprom_hash(state.EEPROM), state.address_bits,
+        state.early_reset, state.cycles, state.bus,
+        state.reg_a, state.reg_b, state.reg_instruction,
+        state.reg_memory_address, state.reg_program_counter, state.reg_output,
+        state.reg_flags, state.alu, state.microinstruction_counter, bits,
+        len(state.memory),
+    )
+    return header + bytes(state.memory)
+
+
+def loads(state, snapshot):
+    """Restore the state of the machine from a snapshot.
+
+    Parameters
+    ----------
+    state : State
+        The state of the machine as defined in simulator.py. This will be
+        overwritten by the state stored in the snapshot. The microcode EEPROM,
+        address width and early reset setting of this state should match the
+        ones used when creating the snapshot.
+    snapshot : bytes
+        The snapshot, as created by ``dumps()``.
+    """
+    if len(snapshot) < _HEADER.size or snapshot[:len(MAGIC)] != MAGIC:
+        raise ValueError('Not a snapshot of the 8-bit breadboard computer.')
+    (_, version, EEPROM_hash, address_bits, early_reset, cycles, bus, reg_a, reg_b, reg_instruction,
+     reg_memory_address, reg_program_counter, reg_output, reg_flags, alu,
+     microinstruction_counter, bits, memory_size) = _HEADER.unpack_from(snapshot)
+    if version != VERSION:
+        raise ValueError(f'Unsupported snapshot version: {version}.')
+    if EEPROM_hash != microcode.eeprom_hash(state.EEPROM):
+        raise ValueError('The snapshot was created with different microcode.')
+    if address_bits != state.address_bits:
+        raise ValueError(f'The snapshot was created with {address_bits} address bits, '
+                         f'but the machine has {state.address_bits}.')
+    if early_reset != state.early_reset:
+        raise ValueError(f'The snapshot was created with early reset {"on" if early_reset else "off"}, '
+                         f'but the machine has it {"on" if state.early_reset else "off"}.')
+    memory = snapshot[_HEADER.size:]
+    if len(memory) != memory_size:
+        raise ValueError('The snapshot is truncated.')
+    if len(memory) > len(state.memory):
+        raise ValueError(f'The snapshot holds {len(memory)} bytes of RAM, '
+                         f'but the machine only has {len(state.memory)}.')
+
+    state.cycles = cycles
+    state.bus = bus
+    state.reg_a = reg_a
+    state.reg_b = reg_b
+    state.reg_instruction = reg_instruction
+    state.reg_memory_address = reg_memory_address
+    state.reg_program_counter = reg_program_counter
+    state.reg_output = reg_output
+    state.reg_flags = reg_flags
+    state.alu = alu
+    state.microinstruction_counter = microinstruction_counter
+    state.clock = bool(bits & _CLOCK)
+    state.flag_carry = bool(bits & _CARRY)
+    state.flag_zero = bool(bits & _ZERO)
+    # Write into the existing RAM, which may be mapped to a file (see
+    # memory_backend.py). Addresses beyond the end of the snapshot are empty.
+    state.memory[:] = memory + bytes(len(state.memory) - len(memory))
+
+    # The control signals follow from the other registers
+    state.update_control_signals()
+    state.history.clear()
+
+
+def save(state, filename):
+    """Save the state of the machine to a snapshot file.
+
+    Parameters
+    ----------
+    state : State
+        The state of the machine as defined in simulator.py.
+    filename : str
+        The file to write the snapshot to.
+    """
+    with open(filename, 'wb') as f:
+        f.write(dumps(state))
+
+
+def load(state, filename):
+    """Restore the state of the machine from a snapshot file.
+
+    Parameters
+    ----------
+    state : State
+        The state of the machine as defined in simulator.py. This will be
+        overwritten by the state stored in the snapshot.
+    filename : str
+        The snapshot file to read.
+    """
+    with open(filename, 'rb') as f:
+        loads(state, f.read())
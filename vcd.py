@@ -0,0 +1,107 @@
+"""
+Record the signals of the SAP-1 8-bit breadboard computer simulator to a Value
+Change Dump (VCD) file, to be viewed in a waveform viewer such as GTKWave.
+
+The dump is written while the simulation runs and only records the values that
+changed, so even very long runs produce a file of modest size.
+"""
+import microcode
+from memory_backend import DEFAULT_ADDRESS_BITS
+from observer import Observer
+
+# The names of the control lines, see microcode.py
+CONTROL_LINES = ['HLT', 'MI', 'RI', 'RO', 'IO', 'II', 'AI', 'AO', 'EO', 'SU',
+                 'BI', 'OI', 'CE', 'CO', 'J', 'FI']
+
+# The registers to record: name in the dump, attribute of State and width in
+# bits. The width of the address registers (``None``) depends on the machine.
+REGISTERS = [
+    ('bus', 'bus', 8),
+    ('A', 'reg_a', 8),
+    ('B', 'reg_b', 8),
+    ('ALU', 'alu', 8),
+    ('IR', 'reg_instruction', 8),
+    ('MAR', 'reg_memory_address', None),
+    ('PC', 'reg_program_counter', None),
+    ('OUT', 'reg_output', 8),
+    ('flags', 'reg_flags', 2),
+    ('step', 'microinstruction_counter', 3),
+]
+
+
+class VCDWriter(Observer):
+    """Writes the signals of the machine to a VCD file.
+
+    Attach it as an observer to the simulator (see observer.py) to record
+    every step of the clock. Each step (half a clock cycle) takes one unit of
+    time.
+
+    Parameters
+    ----------
+    f : file-like
+        The text file to write the dump to.
+    timescale : str
+        The duration of a unit of time. Defaults to ``'1 us'``.
+    address_bits : int
+        The width of the memory address register and program counter of the
+        machine. Defaults to 4, like the original computer.
+    """
+    def __init__(self, f, timescale='1 us', address_bits=DEFAULT_ADDRESS_BITS):
+        self.f = f
+        self._last = None
+
+        # Each signal is identified in the dump by a short code of printable
+        # characters.
+        self._signals = [('clk', 'clock', 1)] + [
+            (name, attr, address_bits if width is None else width)
+            for name, attr, width in REGISTERS
+        ]
+        codes = [chr(33 + i) for i in range(len(self._signals) + len(CONTROL_LINES))]
+        self._codes = codes[:len(self._signals)]
+        self._control_lines = [(getattr(microcode, name), code)
+                               for name, code in zip(CONTROL_LINES, codes[len(self._signals):])]
+
+        f.write(f'$timescale {timescale} $end\n')
+        f.write('$scope module sap1 $end\n')
+        for (name, _, width), code in zip(self._signals, self._codes):
+            f.write(f'$var wire {width} {code} {name} $end\n')
+        for name, (_, code) in zip(CONTROL_LINES, self._control_lines):
+            f.write(f'$var wire 1 {code} {name} $end\n')
+        f.write('$upscope $end\n')
+        f.write('$enddefinitions $end\n')
+
+    def sample(self, state):
+        """Record the current values of the signals, if they changed.
+
+        Parameters
+        ----------
+        state : State
+            The state of the machine as defined in simulator.py.
+        """
+        values = tuple(int(getattr(state, attr)) for _, attr, _ in self._signals)
+        control_signals = state.control_signals
+        if self._last is None:
+            # Write all values the first time
+            last_values = (None,) * len(values)
+            changed = 0xffff
+        else:
+            last_values, last_control_signals = self._last
+            changed = control_signals ^ last_control_signals
+            if values == last_values and not changed:
+                return
+
+        lines = [f'#{2 * state.cycles - state.clock}']
+        for (_, _, width), code, value, last_value in zip(self._signals, self._codes, values, last_values):
+            if value != last_value:
+                if width == 1:
+                    lines.append(f'{value}{code}')
+                else:
+                    lines.append(f'b{value:b} {code}')
+        for signal, code in self._control_lines:
+            if changed & signal:
+                lines.append(f'{int(bool(control_signals & signal))}{code}')
+        self.f.write('\n'.join(lines) + '\n')
+        self._last = (values, control_signals)
+
+    def on_half_step(self, state):
+        self.sample(state)
@@ -0,0 +1,331 @@
+"""
+Vectorized simulator for running many SAP-1 8-bit breadboard computers at once.
+
+The state of all machines is kept in NumPy arrays, which are advanced half a
+clock cycle at a time, following the same logic as State in simulator.py. This
+is useful for running thousands of programs, initial RAM images or microcode
+variations in one go. Requires NumPy.
+
+Running this script with ``--check`` performs a differential test against the
+simulator in simulator.py.
+"""
+from argparse import ArgumentParser
+
+import numpy as np
+
+import microcode
+from assembler import assemble
+from memory_backend import map_EEPROM, check_address_bits, DEFAULT_ADDRESS_BITS
+
+
+class VectorState:
+    """The state of many machines, simulated in lockstep.
+
+    The names of the attributes match those of State in simulator.py, but each
+    holds an array with a value for each machine.
+
+    Parameters
+    ----------
+    memories : list of list of int
+        For each machine, the initial contents of the RAM. Shorter programs are
+        padded with zeros.
+    EEPROMs : list of (list of int | bytes) | list of int | bytes | None
+        The binary contents of the EEPROMs to use as microcode. Either a single
+        image to use for all machines, or one image for each machine. By
+        default (``None``) Ben Eater's original microcode is used.
+    early_reset : bool
+        Whether to reset the microinstruction counter as soon as the remaining
+        steps of an instruction are empty (see microcode.decode()). Defaults to
+        ``False``.
+    address_bits : int
+        The width of the memory address register and program counter, which
+        determines the size of the RAM. Defaults to 4 (16 bytes of RAM).
+    """
+    def __init__(self, memories, EEPROMs=None, early_reset=False, address_bits=DEFAULT_ADDRESS_BITS):
+        n_machines = len(memories)
+
+        check_address_bits(address_bits)
+        self.address_bits = address_bits
+        self.address_mask = (1 << address_bits) - 1
+        ram_size = 1 << address_bits
+        for memory in memories:
+            if len(memory) > ram_size:
+                raise ValueError(f'The program is {len(memory)} bytes long, '
+                                 f'which does not fit in {ram_size} bytes of RAM.')
+        self.memory = np.zeros((n_machines, ram_size), dtype=np.int64)
+        for machine, memory in enumerate(memories):
+            self.memory[machine, :len(memory)] = memory
+
+        # Decode each microcode image and make a table of the control words and
+        # bus sources for each machine.
+        if EEPROMs is None:
+            EEPROMs = [microcode.EEPROM]
+        elif len(EEPROMs) == 0 or isinstance(EEPROMs[0], int):
+            EEPROMs = [EEPROMs]
+        elif len(EEPROMs) != n_machines:
+            raise ValueError('Either specify a single EEPROM image or one for each machine.')
+        tables = [microcode.decode(EEPROM, early_reset) for EEPROM in EEPROMs]
+        self._control_words = np.array([[m.control_word for m in t] for t in tables], dtype=np.int64)
+        self._bus_sources = np.array([[m.bus_source for m in t] for t in tables], dtype=np.int64)
+        self._next_steps = np.array([[m.next_step for m in t] for t in tables], dtype=np.int64)
+        if len(EEPROMs) == 1:
+            self._image = np.zeros(n_machines, dtype=np.int64)
+        else:
+            self._image = np.arange(n_machines)
+
+        def zeros(dtype=np.int64):
+            return np.zeros(n_machines, dtype=dtype)
+
+        self.bus = zeros()
+        self.rom_address = zeros()
+        self.reg_a = zeros()
+        self.reg_b = zeros()
+        self.reg_instruction = zeros()
+        self.reg_memory_address = zeros()
+        self.reg_program_counter = zeros()
+        self.reg_output = zeros()
+        self.reg_flags = zeros()
+        self.control_signals = zeros()
+        self.flag_carry = zeros(bool)
+        self.flag_zero = zeros(bool)
+        self.clock = zeros(bool)
+        self.alu = zeros()
+        self.microinstruction_counter = zeros()
+        self.cycles = zeros()
+        self.outputs = [list() for _ in range(n_machines)]
+
+        everything = np.ones(n_machines, dtype=bool)
+        self.update_control_signals(everything)
+        self._update_components(everything)
+        self.update_control_signals(everything)
+
+    @property
+    def halted(self):
+        """For each machine, whether the HLT signal is active."""
+        return (self.control_signals & microcode.HLT) != 0
+
+    def update_control_signals(self, mask):
+        """Update the control signals of the selected machines based on the
+        microcode EEPROMs."""
+        self.rom_address[mask] = (
+            (self.reg_flags[mask] << 8) +
+            ((self.reg_instruction[mask] & 0xf0) >> 1) +
+            self.microinstruction_counter[mask]
+        )
+        self.control_signals[mask] = self._control_words[self._image[mask], self.rom_address[mask]]
+
+    def _update_components(self, mask):
+        """Write to and read from the bus and compute the ALU outputs of the
+        selected machines, based on the current values of the control lines."""
+        signals = self.control_signals
+
+        # Write to the bus
+        bus_source = np.where(mask, self._bus_sources[self._image, self.rom_address], microcode.BUS_NONE)
+        for source, value in [(microcode.BUS_A, self.reg_a),
+                              (microcode.BUS_ALU, self.alu),
+                              (microcode.BUS_INSTRUCTION, self.reg_instruction & 0x0f),
+                              (microcode.BUS_PC, self.reg_program_counter)]:
+            np.copyto(self.bus, value, where=bus_source == source)
+        ram_out = np.flatnonzero(bus_source == microcode.BUS_RAM)
+        self.bus[ram_out] = self.memory[ram_out, self.reg_memory_address[ram_out]]
+
+        # Read from the bus
+        latch = mask & self.clock
+        for signal, register in [(microcode.AI, self.reg_a),
+                                 (microcode.BI, self.reg_b),
+                                 (microcode.II, self.reg_instruction),
+                                 (microcode.MI, self.reg_memory_address),
+                                 (microcode.J, self.reg_program_counter)]:
+            np.copyto(register, self.bus, where=latch & ((signals & signal) != 0))
+        self.reg_memory_address &= self.address_mask
+        self.reg_program_counter &= self.address_mask
+        ram_in = np.flatnonzero(latch & ((signals & microcode.RI) != 0))
+        self.memory[ram_in, self.reg_memory_address[ram_in]] = self.bus[ram_in]
+        np.copyto(self.reg_output, self.bus, where=latch & ((signals & microcode.OI) != 0))
+
+        # Transfer ALU flag outputs to the flags register
+        np.copyto(self.reg_flags, self.flag_carry + (self.flag_zero.astype(np.int64) << 1),
+                  where=latch & ((signals & microcode.FI) != 0))
+
+        # Do ALU stuff, set flag outputs
+        subtract = (signals & microcode.SU) != 0
+        alu = self.reg_a + np.where(subtract, (self.reg_b ^ 0xff) + 1, self.reg_b)
+        np.copyto(self.flag_carry, alu > 0xff, where=mask)
+        np.copyto(self.alu, alu & 0xff, where=mask)
+        np.copyto(self.flag_zero, self.alu == 0, where=mask)
+
+    def step(self):
+        """Perform a single step (half a clock-cycle) on all machines that have
+        not halted yet."""
+        running = ~self.halted
+
+        # Flip clock signal
+        self.clock ^= running
+        rising = running & self.clock
+        falling = running & ~self.clock
+
+        # Clock goes high
+        self.cycles += rising
+        increment = rising & ((self.control_signals & microcode.CE) != 0)
+        self.reg_program_counter[increment] = (self.reg_program_counter[increment] + 1) & self.address_mask
+
+        # Clock goes low
+        self.microinstruction_counter[falling] = self._next_steps[self._image[falling], self.rom_address[falling]]
+        self.update_control_signals(falling)
+
+        # Changes of instruction and flags registers affect the control lines
+        recompute = rising & ((self.control_signals & (microcode.II | microcode.FI)) != 0)
+        self._update_components(running)
+        self.update_control_signals(recompute)
+
+        # Keep track of the values written to the output module
+        for machine in np.flatnonzero(rising & ((self.control_signals & microcode.OI) != 0)):
+            self.outputs[machine].append(int(self.reg_output[machine]))
+
+    def run(self, max_cycles=None):
+        """Run all machines until they halt.
+
+        Parameters
+        ----------
+        max_cycles : int | None
+            The maximum number of clock cycles to run. By default (``None``),
+            there is no limit.
+
+        Returns
+        -------
+        outputs : list of list of int
+            For each machine, the result of any OUT instructions encountered
+            along the way.
+        halted : array of bool
+            For each machine, whether it reached the HLT instruction.
+        cycles : array of int
+            For each machine, the number of clock cycles it ran for.
+        """
+        while not self.halted.all():
+            if max_cycles is not None and self.cycles.max() >= max_cycles:
+                break
+            self.step()
+        return self.outputs, self.halted, self.cycles.copy()
+
+
+def compare_engines(memories, EEPROMs=None, max_cycles=10_000, early_reset=False,
+                    address_bits=DEFAULT_ADDRESS_BITS):
+    """Run the vectorized simulator in lockstep with the simulator in
+    simulator.py and report where they first diverge.
+
+    Parameters
+    ----------
+    memories : list of list of int
+        For each machine, the initial contents of the RAM.
+    EEPROMs : list of (list of int | bytes) | list of int | bytes | None
+        The binary contents of the EEPROMs to use as microcode, as for
+        ``VectorState``. By default (``None``) Ben Eater's original microcode
+        is used.
+    max_cycles : int
+        The maximum number of clock cycles to run. Defaults to 10 000.
+    early_reset : bool
+        Whether both simulators reset the microinstruction counter as soon as
+        the remaining steps of an instruction are empty. Defaults to ``False``.
+    address_bits : int
+        The width of the memory address register and program counter. Defaults
+        to 4 (16 bytes of RAM).
+
+    Returns
+    -------
+    divergences : list of (str | None)
+        For each machine, a description of the first difference between the
+        simulators, or ``None`` if they agree.
+    """
+    from instruction_engine import ARCHITECTURAL_REGISTERS
+    from simulator import Simulator
+
+    vector = VectorState(memories, EEPROMs, early_reset, address_bits)
+    if EEPROMs is None or len(EEPROMs) == 0 or isinstance(EEPROMs[0], int):
+        EEPROMs = [EEPROMs] * len(memories)
+    states = [Simulator(memory, EEPROM=EEPROM, early_reset=early_reset, address_bits=address_bits).state
+              for memory, EEPROM in zip(memories, EEPROMs)]
+    outputs = [list() for _ in states]
+    divergences = [None] * len(states)
+    for state in states:
+        state.keep_history = False
+
+    while not vector.halted.all() and vector.cycles.max() < max_cycles:
+        vector.step()
+        for machine, state in enumerate(states):
+            if divergences[machine] is not None or state.halted:
+                continue
+            out = state.step()
+            if out is not None:
+                outputs[machine].append(out)
+
+            differences = [
+                f'{name}: {getattr(state, name)} != {getattr(vector, name)[machine]}'
+                for name in ARCHITECTURAL_REGISTERS
+                if getattr(state, name) != getattr(vector, name)[machine]
+            ]
+            if list(state.memory) != vector.memory[machine].tolist():
+                differences.append(f'memory: {list(state.memory)} != {vector.memory[machine].tolist()}')
+            if outputs[machine] != vector.outputs[machine]:
+                differences.append(f'outputs: {outputs[machine]} != {vector.outputs[machine]}')
+            if state.halted != vector.halted[machine]:
+                differences.append(f'halted: {state.halted} != {vector.halted[machine]}')
+            if differences:
+                divergences[machine] = (f'Cycle {state.cycles}, clock {"high" if state.clock else "low"}: '
+                                        + ', '.join(differences))
+    return divergences
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Run many programs, possibly with many versions of the microcode, on the 8-bit breadboard computer at the same time.')
+    parser.add_argument('program_files', type=str, nargs='+', help='Programs to execute, written in assembly language.')
+    parser.add_argument('-m', '--microcode', type=str, metavar='bin_file', nargs='+', default=None,
+                        help='EEPROM contents to use as microcode (as binary memory dumps). Each program is run with each version of the microcode. Defaults to Ben Eaters original microcode.')
+    parser.add_argument('-c', '--max-cycles', type=int, default=10_000,
+                        help='Maximum number of clock cycles to run each program for. Defaults to 10 000.')
+    parser.add_argument('--address-bits', type=int, default=DEFAULT_ADDRESS_BITS,
+                        help='Width of the memory address register and program counter, which determines the size of the RAM. Defaults to 4 (16 bytes).')
+    parser.add_argument('--early-reset', action='store_true',
+                        help='Reset the microinstruction counter as soon as the remaining steps of an instruction are empty, so instructions take fewer clock cycles (see "microcode.py --analyze").')
+    parser.add_argument('--check', action='store_true',
+                        help='Run the programs on the simulator in simulator.py as well and report where the results differ, both with and without --early-reset.')
+    args = parser.parse_args()
+    try:
+        check_address_bits(args.address_bits)
+    except ValueError as e:
+        parser.error(str(e))
+
+    programs = list()
+    for program_file in args.program_files:
+        with open(program_file) as f:
+            programs.append(assemble(f.read())[0])
+
+    if args.microcode:
+        images = list()
+        for microcode_file in args.microcode:
+            images.append(map_EEPROM(microcode_file))
+    else:
+        images = [microcode.EEPROM]
+        args.microcode = ['']
+
+    memories = [program for _ in images for program in programs]
+    EEPROMs = [image for image in images for _ in programs]
+    names = [f'{microcode_file} {program_file}'.strip()
+             for microcode_file in args.microcode for program_file in args.program_files]
+
+    if args.check:
+        all_ok = True
+        for early_reset in (False, True):
+            divergences = compare_engines(memories, EEPROMs, args.max_cycles, early_reset, args.address_bits)
+            mode = ' (early reset)' if early_reset else ''
+            for name, divergence in zip(names, divergences):
+                if divergence is None:
+                    print(f'{name}{mode}: OK')
+                else:
+                    print(f'{name}{mode}: {divergence}')
+                    all_ok = False
+        raise SystemExit(0 if all_ok else 1)
+
+    outputs, halted, cycles = VectorState(memories, EEPROMs, args.early_reset, args.address_bits).run(args.max_cycles)
+    for name, out, h, c in zip(names, outputs, halted, cycles):
+        status = 'halted' if h else 'running'
+        print(f'{name}: {" ".join(map(str, out))} ({status} after {c} cycles)')
@@ -0,0 +1,202 @@
+"""
+Run the simulator of the SAP-1 8-bit breadboard computer in a background
+thread.
+
+The user interface controls the simulator by sending commands to the worker
+through a queue. The worker publishes snapshots of the state of the machine,
+which the user interface can read at any time without waiting for the
+simulator. This way, a slow terminal does not stall the clock and a fast clock
+does not make the user interface unresponsive.
+"""
+from collections import namedtuple
+from queue import Queue, Empty
+from threading import Thread
+from time import time
+
+import microcode
+
+# How many times per second a snapshot is published while the clock is
+# running.
+PUBLISH_RATE = 30
+
+# An immutable copy of the state of the machine, along with the settings of the
+# clock. The names of the fields match those of State and Simulator in
+# simulator.py, so it can be drawn by interface.update().
+Snapshot = namedtuple('Snapshot', [
+    'bus', 'rom_address', 'reg_a', 'reg_b', 'reg_instruction',
+    'reg_memory_address', 'reg_program_counter', 'reg_output', 'reg_flags',
+    'control_signals', 'clock', 'alu', 'microinstruction_counter', 'cycles',
+    'memory', 'memory_human_readable', 'output_signed_mode',
+    'clock_automatic', 'clock_speed', 'measured_clock_speed',
+])
+
+
+class SimulatorWorker(Thread):
+    """Background thread that runs the simulator.
+
+    Commands are sent through ``send()``. The latest snapshot of the state is
+    available as the ``snapshot`` attribute. Messages for the user, such as
+    the outcome of a command, are put in the ``messages`` queue.
+
+    The supported commands are:
+
+    - ``('toggle_run',)``: start the clock when it is stopped and vice versa
+    - ``('scale_speed', factor)``: multiply the clock speed by a factor
+    - ``('step',)``: step the clock
+    - ``('step_back',)``: step the clock backwards
+    - ``('next_instruction',)``: step the clock until the next instruction
+    - ``('reverse_to_output',)``: go back to the previous output
+    - ``('reverse_to_write', address)``: go back to the previous write of a
+      RAM address
+    - ``('toggle_output_mode',)``: toggle between signed and unsigned output
+    - ``('reset',)``: reset the machine
+    - ``('save_state', filename)``: save the state of the machine to a file
+    - ``('add_breakpoint', spec)``: add a breakpoint (see breakpoints.py)
+    - ``('clear_breakpoints',)``: remove all breakpoints
+    - ``('quit',)``: stop the worker
+
+    Parameters
+    ----------
+    simulator : Simulator
+        The simulator to run. After starting the worker, it should no longer
+        be used directly.
+    """
+    def __init__(self, simulator):
+        super().__init__(daemon=True)
+        self.simulator = simulator
+        self.commands = Queue()
+        self.messages = Queue()
+        self.measured_clock_speed = None
+        self._measure_time = time()
+        self._measure_cycles = simulator.state.cycles
+        self._publish()
+
+    def send(self, *command):
+        """Send a command to the worker. See the class documentation for the
+        supported commands."""
+        self.commands.put(command)
+
+    def run(self):
+        """Process commands and run the clock until the quit command is
+        received."""
+        simulator = self.simulator
+        while True:
+            # While the clock is running, don't wait for commands
+            try:
+                command = self.commands.get(block=not simulator.clock_automatic)
+            except Empty:
+                command = None
+            if command == ('quit',):
+                break
+            if command is not None:
+                self._execute(*command)
+            else:
+                simulator.run_until(time() + 1 / PUBLISH_RATE)
+
+            # When we reach the end of the program, set the clock to manual
+            # mode so we don't keep generating useless system states.
+            if simulator.state.control_signals & microcode.HLT:
+                simulator.clock_automatic = False
+
+            # Stop the clock at breakpoints
+            if simulator.breakpoints.hit is not None:
+                simulator.clock_automatic = False
+                self.messages.put(simulator.breakpoints.hit)
+                simulator.breakpoints.hit = None
+            self._measure()
+            self._publish()
+
+    def _execute(self, name, *args):
+        """Execute a single command."""
+        simulator = self.simulator
+        state = simulator.state
+        if name == 'toggle_run':
+            simulator.clock_automatic = not simulator.clock_automatic
+            simulator.last_clock_time = time()
+            self.messages.put('Started clock.' if simulator.clock_automatic else 'Stopped clock.')
+        elif name == 'scale_speed':
+            factor = args[0]
+            simulator.clock_speed *= factor
+            self.messages.put(f'{"Increased" if factor > 1 else "Decreased"} clock to {simulator.clock_speed} Hz.')
+        elif name == 'step':
+            simulator.step()
+        elif name == 'step_back':
+            simulator.step_back()
+        elif name == 'next_instruction':
+            simulator.step()
+            while (simulator.state.microinstruction_counter > 0 or not simulator.state.clock) and not simulator.state.control_signals & microcode.HLT:
+                simulator.step()
+        elif name == 'reverse_to_output':
+            if simulator.reverse_to_output():
+                self.messages.put('Went back to the previous output.')
+            else:
+                self.messages.put('There is no previous output.')
+        elif name == 'reverse_to_write':
+            address = args[0]
+            if simulator.reverse_to_write(address):
+                self.messages.put(f'Went back to the previous write of address {address}.')
+            else:
+                self.messages.put(f'Address {address} was not written to before.')
+        elif name == 'toggle_output_mode':
+            state.output_signed_mode = not state.output_signed_mode
+        elif name == 'reset':
+            simulator.reset()
+        elif name == 'save_state':
+            try:
+                simulator.save_state(args[0])
+                self.messages.put(f'Saved state to {args[0]}.')
+            except OSError as e:
+                self.messages.put(f'Could not save state: {e}')
+        elif name == 'add_breakpoint':
+            try:
+                simulator.add_breakpoint(args[0])
+                self.messages.put(f'Added breakpoint "{args[0]}".')
+            except ValueError as e:
+                self.messages.put(str(e))
+        elif name == 'clear_breakpoints':
+            simulator.clear_breakpoints()
+            self.messages.put('Removed all breakpoints.')
+        else:
+            raise ValueError(f'Unknown command: {name}')
+
+    def _measure(self):
+        """Measure the actual clock speed every half a second while the clock is
+        running."""
+        now = time()
+        cycles = self.simulator.state.cycles
+        if not self.simulator.clock_automatic:
+            self.measured_clock_speed = None
+        elif now - self._measure_time < 0.5:
+            return
+        else:
+            self.measured_clock_speed = (cycles - self._measure_cycles) / (now - self._measure_time)
+        self._measure_time = now
+        self._measure_cycles = cycles
+
+    def _publish(self):
+        """Publish a snapshot of the current state. Replacing the snapshot is a
+        single assignment, so readers never see a half-updated snapshot."""
+        simulator = self.simulator
+        state = simulator.state
+        self.snapshot = Snapshot(
+            bus=state.bus,
+            rom_address=state.rom_address,
+            reg_a=state.reg_a,
+            reg_b=state.reg_b,
+            reg_instruction=state.reg_instruction,
+            reg_memory_address=state.reg_memory_address,
+            reg_program_counter=state.reg_program_counter,
+            reg_output=state.reg_output,
+            reg_flags=state.reg_flags,
+            control_signals=state.control_signals,
+            clock=state.clock,
+            alu=state.alu,
+            microinstruction_counter=state.microinstruction_counter,
+            cycles=state.cycles,
+            memory=bytes(state.memory),
+            memory_human_readable=tuple(state.memory_human_readable),
+            output_signed_mode=state.output_signed_mode,
+            clock_automatic=simulator.clock_automatic,
+            clock_speed=simulator.clock_speed,
+            measured_clock_speed=self.measured_clock_speed,
+        )